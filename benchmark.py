@@ -0,0 +1,389 @@
+"""
+Micro benchmarks for the hot paths of the client, plus a convergence
+check of the request window against simulated peers and a check of
+the piece picker while picked pieces get started.
+
+Usage: python benchmark.py [name ...]
+"""
+import sys
+import time
+import heapq
+import random
+import socket
+import struct
+from collections import OrderedDict
+
+import codec
+import decoder
+import engine
+import entities
+import pieces
+
+
+def bencode(obj, out):
+    """Minimal encoder used only to build synthetic inputs"""
+    if isinstance(obj, int):
+        out += b'i%de' % obj
+    elif isinstance(obj, bytes):
+        out += b'%d:' % len(obj) + obj
+    elif isinstance(obj, list):
+        out += b'l'
+        for el in obj:
+            bencode(el, out)
+        out += b'e'
+    else:
+        out += b'd'
+        for key, val in obj.items():
+            bencode(key, out)
+            bencode(val, out)
+        out += b'e'
+    return out
+
+
+def synthetic_metainfo(nr_files, nr_pieces):
+    """Build a multi-file metainfo similar to real world torrents"""
+    files = [
+        OrderedDict([
+            (b'length', 1000 + i),
+            (b'path', [b'directory_%d' % (i // 100), b'file_%d.bin' % i]),
+        ])
+        for i in range(nr_files)
+    ]
+    info = OrderedDict([
+        (b'files', files),
+        (b'name', b'synthetic'),
+        (b'piece length', 2**18),
+        (b'pieces', bytes(range(20)) * nr_pieces),
+    ])
+    meta = OrderedDict([
+        (b'announce', b'http://tracker.example/announce'),
+        (b'info', info),
+    ])
+    return bytes(bencode(meta, bytearray()))
+
+
+class LegacyOrderedDecoder(decoder.BaseDecoderEncoder):
+    """Recursive decoder the client shipped with, kept for comparison"""
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def get_token_type(self, token):
+        for tk in self.tokens:
+            if self.tokens[tk](token):
+                return tk
+
+    def decode_list(self, res_list=None):
+        if not res_list:
+            res_list = []
+            self.index += 1
+        el = self.decode_current_token()
+        if el is not None and el != self.END:
+            res_list.append(el)
+            self.decode_list(res_list)
+        return res_list
+
+    def decode_int(self):
+        self.index += 1
+        num = b''
+        while self.data[self.index: self.index + 1] != b'e':
+            num += self.data[self.index: self.index + 1]
+            self.index += 1
+        self.index += 1
+        return num
+
+    def decode_str(self):
+        str_dig_len = 1
+        while self.data[self.index + str_dig_len:
+                        self.index + str_dig_len + 1] in self.STR:
+            str_dig_len += 1
+        str_len = int(self.data[self.index: self.index + str_dig_len])
+        self.index += str_dig_len + 1
+        string = self.data[self.index: self.index + str_len]
+        self.index += str_len
+        return string
+
+    def decode_dict(self, res_dict=None):
+        if not res_dict:
+            res_dict = OrderedDict()
+            self.index += 1
+        key = self.decode_current_token()
+        if key == self.END:
+            return res_dict
+        value = self.decode_current_token()
+        if not any(el is None for el in (key, value)):
+            res_dict[key] = value
+            self.decode_dict(res_dict)
+        return res_dict
+
+    def decode_end(self):
+        self.index += 1
+        return self.END
+
+    def decode_current_token(self):
+        element = self.data[self.index: self.index + 1]
+        token = self.get_token_type(element)
+        if token:
+            return getattr(self, 'decode_{}'.format(token))()
+        raise decoder.UnrecognizedTokenError
+
+    def decode(self):
+        return self.decode_current_token()
+
+
+def timed(func, repeat=3):
+    """Best wall clock time of `repeat` runs, None on recursion overflow"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            func()
+        except RecursionError:
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_decoder():
+    print('{:>8} {:>8} {:>9} {:>12} {:>12}'.format(
+        'files', 'pieces', 'MB', 'legacy [s]', 'current [s]'))
+    for nr_files, nr_pieces in ((0, 50000), (200, 20000),
+                                (20000, 100000), (100000, 200000)):
+        data = synthetic_metainfo(nr_files, nr_pieces)
+        current = timed(lambda: decoder.OrderedDecoder(data).decode())
+        legacy = timed(lambda: LegacyOrderedDecoder(data).decode())
+        print('{:>8} {:>8} {:>9.2f} {:>12} {:>12.4f}'.format(
+            nr_files, nr_pieces, len(data) / 2**20,
+            'recursion' if legacy is None else '{:.4f}'.format(legacy),
+            current))
+
+
+def legacy_message(clz):
+    """
+    Message instance as PeerMessage.__init__ builds it, minus the
+    pieces manager lookup which needs a running client
+    """
+    instance = clz.__new__(clz)
+    instance.peer_id = instance.info_hash = None
+    instance.initial_len = instance.msg_len = None
+    instance.msg_buffer = bytearray()
+    instance.complete_msg = bytearray()
+    return instance
+
+
+def legacy_encode_request(index, begin, length):
+    request = legacy_message(entities.Request)
+    request.piece_ind = None
+    return request.encode(index, begin, length)
+
+
+def legacy_decode(msg):
+    """PeerMessage.delegate followed by unpacking of the message"""
+    class_name = entities.PeerMessage.msg_ids.get(msg[4:5], '')
+    clz = vars(entities).get(class_name)
+    instance = legacy_message(clz)
+    instance.msg_len = instance.initial_len = clz.get_len(msg)
+    instance.msg_buffer = bytearray(msg)
+    instance.complete_msg = instance.msg_buffer[:]
+    if class_name == 'Have':
+        return struct.unpack('!IBI', instance.complete_msg)[2]
+    return struct.unpack('!IBIII', instance.complete_msg)[2:]
+
+
+def bench_codec(nr_messages=200000):
+    requests = [(i // 16, (i % 16) * 2**14, 2**14) for i in range(nr_messages)]
+    writer = codec.MessageWriter()
+
+    def encode():
+        for request in requests:
+            writer.request(*request)
+        writer.flush()
+
+    def encode_legacy():
+        b''.join(legacy_encode_request(*request) for request in requests)
+
+    stream = b''.join(
+        legacy_encode_request(*request) if i % 2 else
+        struct.pack('!IBI', 5, 4, i) for i, request in enumerate(requests)
+    )
+    frames, messages = [], []
+    offset = 0
+    while offset < len(stream):
+        (msg_len,) = struct.unpack_from('!I', stream, offset)
+        frames.append(memoryview(stream)[offset + 4: offset + 4 + msg_len])
+        messages.append(stream[offset: offset + 4 + msg_len])
+        offset += 4 + msg_len
+
+    decoded = []
+    table = codec.dispatch_table({
+        codec.HAVE: lambda frame: decoded.append(codec.unpack_index(frame)),
+        codec.REQUEST: lambda frame: decoded.append(codec.unpack_block(frame)),
+    }, lambda frame: None)
+
+    def decode():
+        for frame in frames:
+            table[frame[0]](frame)
+
+    def decode_legacy():
+        for msg in messages:
+            decoded.append(legacy_decode(msg))
+
+    print('{:>8} {:>16} {:>16}'.format('', 'legacy [msg/s]', 'codec [msg/s]'))
+    for name, legacy, current in (('encode', encode_legacy, encode),
+                                  ('decode', decode_legacy, decode)):
+        print('{:>8} {:>16,.0f} {:>16,.0f}'.format(
+            name, nr_messages / timed(legacy), nr_messages / timed(current)))
+
+
+def legacy_parse_peers(resp):
+    """Client.parse_peers as the client shipped with, minus printing"""
+    peers = {}
+    try:
+        offset = 6
+        ind = 0
+        peer_nr = 0
+        while True:
+            peer_info = resp[ind: ind + offset]
+            peer_ip = socket.inet_ntoa(peer_info[:4])
+            peer_port = struct.unpack('!H', peer_info[4:6])
+            peers[peer_nr] = (peer_ip, peer_port)
+            peer_nr += 1
+            ind += offset
+    except Exception:
+        pass
+    return peers
+
+
+def bench_peers(nr_peers=10000):
+    rand = random.Random(1)
+    # every tenth peer is announced twice
+    peers = [(rand.getrandbits(32), rand.randrange(1, 2**16))
+             for _ in range(nr_peers)]
+    peers += peers[::10]
+    compact = b''.join(struct.pack('!IH', ip, port) for ip, port in peers)
+    compact6 = b''.join(struct.pack('!QQH', ip, ip, port)
+                        for ip, port in peers[:nr_peers // 10])
+    response = bytes(bencode(OrderedDict([
+        (b'interval', 1800),
+        (b'peers', compact),
+        (b'peers6', compact6),
+    ]), bytearray()))
+    print('{} peers, {} IPv6, {:.0f} KB response'.format(
+        len(peers), nr_peers // 10, len(response) / 2**10))
+
+    parse_peers = entities.Client.parse_peers
+    decoded = decoder.OrderedDecoder(response).decode()
+    result = parse_peers(decoded)
+    print('{} unique addresses'.format(len(result)))
+    print('{:>20} {:>12}'.format('', 'time [s]'))
+    for name, func in (
+            ('legacy (IPv4 only)',
+             lambda: legacy_parse_peers(decoded[b'peers'])),
+            ('parse', lambda: parse_peers(decoded)),
+            ('decode + parse', lambda: parse_peers(
+                decoder.OrderedDecoder(response).decode()))):
+        print('{:>20} {:>12.5f}'.format(name, timed(func)))
+
+
+def simulate_window(rate, rtt, duration=60.0, block_size=2**14):
+    """
+    Window sizes, one per simulated second, of a RequestWindow
+    downloading from a peer serving its request queue in order at a
+    fixed `rate` over a link with round trip `rtt`. Requests are
+    pipelined like PeerConnection does, only requests sent onto an
+    empty pipeline give round trip samples.
+    """
+    window = engine.RequestWindow(block_size)
+    window.rtt_reset = window.rate_start = 0.0
+    service = block_size / rate
+    # (time a block arrives, request number)
+    arrivals = []
+    sent = {}
+    outstanding = set()
+    probe = None
+    peer_free = 0.0
+    next_request = 0
+    now = 0.0
+    sizes = []
+
+    while now < duration:
+        while len(outstanding) < window.size:
+            if not outstanding:
+                probe = next_request
+            sent[next_request] = now
+            outstanding.add(next_request)
+            peer_free = max(peer_free, now + rtt / 2) + service
+            heapq.heappush(arrivals, (peer_free + rtt / 2, next_request))
+            next_request += 1
+        now, request = heapq.heappop(arrivals)
+        outstanding.discard(request)
+        window.sample(block_size,
+                      now - sent.pop(request) if request == probe else None,
+                      now)
+        while len(sizes) < int(now):
+            sizes.append(window.size)
+    return sizes
+
+
+def bench_window():
+    print('{:>10} {:>8} {:>8}  {}'.format(
+        'rate KB/s', 'rtt ms', 'BDP', 'window after 0, 10, ... 60 s'))
+    for rate, rtt in ((2**20, 0.05), (100 * 2**10, 0.02),
+                      (10 * 2**20, 0.2), (50 * 2**20, 0.01)):
+        sizes = simulate_window(rate, rtt)
+        bdp = rate * rtt / 2**14
+        print('{:>10} {:>8} {:>8.1f}  {}'.format(
+            rate // 2**10, int(rtt * 1000), bdp, sizes[::10] + sizes[-1:]))
+        tail = sizes[-20:]
+        # a steady peer leaves the window settled around its BDP
+        assert max(tail) - min(tail) <= max(2, bdp * 0.2), tail
+        assert tail[-1] <= engine.RequestWindow.HEADROOM * (bdp + 2) + 2, \
+            tail
+    print('window converges')
+
+
+def bench_picker(nr_pieces=200000, nr_rounds=200, batch=64):
+    """
+    Pick and start pieces the way PieceManager.schedule does, from a
+    seeder and from a peer having every third piece
+    """
+    rand = random.Random(1)
+    picker = pieces.PiecePicker(nr_pieces)
+    for piece_ind in range(nr_pieces):
+        for _ in range(rand.randrange(1, 4)):
+            picker.peer_has(piece_ind)
+    started = set()
+    print('{:>12} {:>12} {:>14}'.format('peer', 'started', 'pick [ms]'))
+    for name, peer_has in (('seeder', lambda ind: True),
+                           ('every third', lambda ind: not ind % 3)):
+        elapsed = 0.0
+        for _ in range(nr_rounds // 2):
+            start = time.perf_counter()
+            picked = picker.pick(peer_has, batch)
+            elapsed += time.perf_counter() - start
+            for piece_ind in picked:
+                # starting a piece while walking the picks must be safe
+                assert piece_ind not in started and peer_has(piece_ind)
+                picker.mark_started(piece_ind)
+                started.add(piece_ind)
+            assert len(picked) == batch
+        print('{:>12} {:>12} {:>14.3f}'.format(
+            name, len(started), elapsed / (nr_rounds // 2) * 1000))
+    assert sum(map(len, picker.buckets)) == nr_pieces - len(started)
+    print('picker consistent')
+
+
+BENCHMARKS = {
+    'decoder': bench_decoder,
+    'codec': bench_codec,
+    'peers': bench_peers,
+    'window': bench_window,
+    'picker': bench_picker,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
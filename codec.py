@@ -0,0 +1,163 @@
+"""
+Peer wire message encoding and decoding.
+
+Message layouts are precompiled struct.Struct objects. Incoming frames
+(message id followed by payload, as produced by the Framer) are routed
+through a 256 entry table indexed by the message id. Outgoing messages
+are packed into the preallocated buffer of a MessageWriter.
+"""
+import struct
+
+
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+EXTENDED = 20
+
+PSTR = b'BitTorrent protocol'
+
+# whole messages, length prefix included
+HANDSHAKE_MSG = struct.Struct('!B19sQ20s20s')
+HEADER = struct.Struct('!IB')
+HAVE_MSG = struct.Struct('!IBI')
+BLOCK_MSG = struct.Struct('!IBIII')
+PIECE_HEADER = struct.Struct('!IBII')
+EXTENDED_HEADER = struct.Struct('!IBB')
+
+# payloads, read from frames at offset 1 (after the message id)
+INDEX = struct.Struct('!I')
+BLOCK = struct.Struct('!III')
+PIECE_POSITION = struct.Struct('!II')
+PORT_NR = struct.Struct('!H')
+RESERVED = struct.Struct('!Q')
+
+PIECE_HEADER_LEN = 1 + PIECE_POSITION.size
+
+
+def dispatch_table(handlers, default):
+    """
+    List of 256 callables indexed by message id, `handlers` maps
+    message ids to callables, all other ids map to `default`
+    """
+    table = [default] * 256
+    for msg_id, handler in handlers.items():
+        table[msg_id] = handler
+    return table
+
+
+def unpack_index(frame):
+    return INDEX.unpack_from(frame, 1)[0]
+
+
+def unpack_block(frame):
+    """(index, begin, length) of a Request or Cancel frame"""
+    return BLOCK.unpack_from(frame, 1)
+
+
+def unpack_piece_position(frame):
+    """(index, begin) of a Piece frame"""
+    return PIECE_POSITION.unpack_from(frame, 1)
+
+
+def unpack_reserved(handshake):
+    return RESERVED.unpack_from(handshake, 1 + len(PSTR))[0]
+
+
+class MessageWriter:
+    """
+    Packs outgoing messages back to back into one reusable buffer,
+    `flush()` hands them over as a single chunk to write
+    """
+
+    def __init__(self, size=2**12):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def reserve(self, nbytes):
+        """Make room for `nbytes` more, returns the write offset"""
+        offset = self.length
+        self.length = offset + nbytes
+        if self.length > len(self.buffer):
+            self.grow(self.length)
+        return offset
+
+    def grow(self, size):
+        buffer = bytearray(max(2 * len(self.buffer), size))
+        buffer[:len(self.buffer)] = self.buffer
+        self.buffer = buffer
+
+    def handshake(self, info_hash, peer_id, reserved=0):
+        offset = self.reserve(HANDSHAKE_MSG.size)
+        HANDSHAKE_MSG.pack_into(self.buffer, offset, len(PSTR), PSTR,
+                                reserved, info_hash, peer_id)
+
+    def keep_alive(self):
+        offset = self.reserve(INDEX.size)
+        INDEX.pack_into(self.buffer, offset, 0)
+
+    def message(self, msg_id):
+        """Messages without payload: (un)choke, (not) interested"""
+        offset = self.reserve(HEADER.size)
+        HEADER.pack_into(self.buffer, offset, 1, msg_id)
+
+    def have(self, index):
+        # hot path, reserve() inlined
+        offset = self.length
+        self.length = offset + HAVE_MSG.size
+        if self.length > len(self.buffer):
+            self.grow(self.length)
+        HAVE_MSG.pack_into(self.buffer, offset, 5, HAVE, index)
+
+    def bitfield(self, bits):
+        offset = self.reserve(HEADER.size + len(bits))
+        HEADER.pack_into(self.buffer, offset, len(bits) + 1, BITFIELD)
+        self.buffer[offset + HEADER.size: self.length] = bits
+
+    def request(self, index, begin, length):
+        # hot path, reserve() inlined
+        offset = self.length
+        self.length = offset + BLOCK_MSG.size
+        if self.length > len(self.buffer):
+            self.grow(self.length)
+        BLOCK_MSG.pack_into(self.buffer, offset, 13, REQUEST, index, begin, length)
+
+    def cancel(self, index, begin, length):
+        # hot path, reserve() inlined
+        offset = self.length
+        self.length = offset + BLOCK_MSG.size
+        if self.length > len(self.buffer):
+            self.grow(self.length)
+        BLOCK_MSG.pack_into(self.buffer, offset, 13, CANCEL, index, begin, length)
+
+    def piece_header(self, index, begin, block_len):
+        """Header of a Piece message whose block gets sent separately"""
+        offset = self.reserve(PIECE_HEADER.size)
+        PIECE_HEADER.pack_into(self.buffer, offset,
+                               block_len + 9, PIECE, index, begin)
+
+    def piece(self, index, begin, block):
+        self.piece_header(index, begin, len(block))
+        offset = self.reserve(len(block))
+        self.buffer[offset: self.length] = block
+
+    def extended(self, ext_id, payload):
+        offset = self.reserve(EXTENDED_HEADER.size + len(payload))
+        EXTENDED_HEADER.pack_into(self.buffer, offset,
+                                  len(payload) + 2, EXTENDED, ext_id)
+        self.buffer[offset + EXTENDED_HEADER.size: self.length] = payload
+
+    def flush(self):
+        """Everything packed so far as bytes, emptying the writer"""
+        data = bytes(memoryview(self.buffer)[:self.length])
+        self.length = 0
+        return data
@@ -1,9 +1,16 @@
+import re
+import time
 import queue
+import functools
 import random
 import hashlib
 import threading
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from utils import PiecesPeersTransportFactory
+import storage
+from collections import Counter
+from pieces import PieceTable, BlockStates, BufferPool, HashVerifier, \
+    PiecePicker, iter_set_bits
 
 
 class UnrecognizedTokenError(Exception):
@@ -28,11 +35,23 @@ class BaseDecoderEncoder:
         'sep': lambda x: x == BaseDecoderEncoder.SEP
     }
 
-    encode_info = {
-        list: (b'l', b'e'),
-        bytes: (b'', b''),
-        OrderedDict: (b'd', b'e'),
-    }
+    # canonical forms only: no sign on lengths, no leading zeros, no -0
+    INT_TOKEN = re.compile(rb'0|-?[1-9][0-9]*')
+    LEN_TOKEN = re.compile(rb'0|[1-9][0-9]*')
+
+    @classmethod
+    def parse_int(cls, digits):
+        if not cls.INT_TOKEN.fullmatch(digits):
+            raise UnrecognizedTokenError(
+                'Malformed integer {!r}'.format(bytes(digits)))
+        return int(digits)
+
+    @classmethod
+    def parse_len(cls, digits):
+        if not cls.LEN_TOKEN.fullmatch(digits):
+            raise UnrecognizedTokenError(
+                'Malformed string length {!r}'.format(bytes(digits)))
+        return int(digits)
 
     def __init__(self, data):
         self._data = data
@@ -44,183 +63,271 @@ class BaseDecoderEncoder:
 
 
 class OrderedDecoder(BaseDecoderEncoder):
+    """
+    Iterative bencode decoder working over a memoryview of the input.
 
-    def __init__(self, data):
+    Containers are tracked on an explicit stack instead of recursion,
+    so deeply nested or very long lists (e.g. torrents with tens of
+    thousands of files) cannot hit the interpreter recursion limit.
+    """
+
+    _LIST = BaseDecoderEncoder.LIST[0]
+    _DICT = BaseDecoderEncoder.DICT[0]
+    _INT = BaseDecoderEncoder.INT[0]
+    _END = BaseDecoderEncoder.END[0]
+    _NO_KEY = object()
+
+    def __init__(self, data, span_keys=()):
         if not isinstance(data, (bytes, bytearray)):
             raise RuntimeError('Input data must be bytes.')
         super().__init__(data)
+        self.view = memoryview(data)
         self.decoded_data = OrderedDict()
-
-    def get_token_type(self, token):
-        for tk in self.tokens:
-            if self.tokens[tk](token):
-                return tk
-
-    def decode_list(self, res_list=None):
-        """Method for list decoding"""
-        if not res_list:
-            res_list = []
-            self.move()
-        el = self.decode_current_token()
-        if el is not None and el != self.END:
-            res_list.append(el)
-            self.decode_list(res_list)
-        return res_list
-
-    def decode_int(self):
-        """Method for int decoding"""
-        self.move()
-        num = b''
-        while self.data[self.index: self.index + 1] != b'e':
-            num += self.data[self.index: self.index + 1]
-            self.move()
-        self.move()
-        return num
-
-    def get_str_digits_len(self):
-        """Method for finding length of forthcoming string"""
-        str_dig_len = 1
-        while self.data[self.index + str_dig_len:
-                        self.index + str_dig_len + 1] in self.STR:
-            str_dig_len += 1
-        return str_dig_len
-
-    def decode_str(self):
-        """Method for string decoding"""
-        str_dig_len = self.get_str_digits_len()
-        str_len = int(self.data[self.index: self.index + str_dig_len].
-                      decode('utf-8'))
-        self.move(str_dig_len + 1)
-        string = self.data[self.index: self.index + str_len]
-        self.move(str_len)
-        return string
-
-    def move(self, dist=1):
-        """Shortcut for index incrementation"""
-        self.index += dist
-
-    def decode_dict(self, res_dict=None):
-        """Method for dict decoding"""
-        if not res_dict:
-            res_dict = OrderedDict()
-            self.move()
-        key = self.decode_current_token()
-        if key == self.END:
-            return res_dict
-        value = self.decode_current_token()
-        if not any(el is None for el in (key, value)):
-            res_dict[key] = value
-            self.decode_dict(res_dict)
-        return res_dict
-
-    def decode_end(self):
-        """Move index by 1 on end match, return end symbol"""
-        self.move()
-        return self.END
-
-    def decode_sep(self):
-        """Move index by 1 on separator match"""
-        self.move()
-
-    def decode_current_token(self):
-        """The real decoding deal"""
-        element = self.data[self.index: self.index + 1]
-        token = self.get_token_type(element)
-        if token:
-            if token == BaseDecoderEncoder.SEP:
-                self.decode_sep()
-                return self.decode_current_token()
-            return getattr(self, 'decode_{}'.format(token))()
-        raise UnrecognizedTokenError
+        # top level keys whose raw (start, end) byte span gets recorded
+        self.span_keys = frozenset(span_keys)
+        self.spans = {}
 
     def decode(self):
-        """Decoding symbolic start method"""
-        return self.decode_current_token()
+        """Decode the next complete entity starting at current index"""
+        data, view, index = self.data, self.view, self.index
+        size = len(data)
+        find = data.index
+        no_key = self._NO_KEY
+        span_keys = self.span_keys
+        stack = []
+        keys = []
+        starts = []
+        try:
+            while True:
+                token = data[index]
+                if 48 <= token <= 57:
+                    sep = find(b':', index)
+                    start = sep + 1
+                    index = start + self.parse_len(data[index: sep])
+                    if index > size:
+                        raise UnrecognizedTokenError('String exceeds input')
+                    value = bytes(view[start: index])
+                elif token == self._DICT or token == self._LIST:
+                    stack.append(OrderedDict() if token == self._DICT else [])
+                    keys.append(no_key)
+                    starts.append(index)
+                    index += 1
+                    continue
+                elif token == self._INT:
+                    end = find(b'e', index)
+                    value = self.parse_int(data[index + 1: end])
+                    index = end + 1
+                elif token == self._END and stack and keys[-1] is no_key:
+                    index += 1
+                    keys.pop()
+                    value = stack.pop()
+                    start = starts.pop()
+                    if len(stack) == 1 and keys[0] in span_keys:
+                        self.spans[keys[0]] = (start, index)
+                else:
+                    raise UnrecognizedTokenError(
+                        'Unexpected token {!r}'.format(chr(token)))
+
+                if not stack:
+                    return value
+                parent = stack[-1]
+                if type(parent) is list:
+                    parent.append(value)
+                elif keys[-1] is no_key:
+                    if type(value) is not bytes:
+                        raise UnrecognizedTokenError(
+                            'Dictionary key must be a string')
+                    keys[-1] = value
+                else:
+                    parent[keys[-1]] = value
+                    keys[-1] = no_key
+        except IndexError:
+            raise UnrecognizedTokenError('Unexpected end of data')
+        except ValueError:
+            raise UnrecognizedTokenError('Malformed token at {}'.format(index))
+        finally:
+            self.index = index
+
+
+class IncrementalDecoder(BaseDecoderEncoder):
+    """
+    Push style bencode decoder for inputs arriving in chunks.
+
+    Partial tokens are kept between `feed` calls, so every byte is
+    looked at exactly once no matter how the input is split. Completed
+    top level objects are handed to `callback` if one is given and
+    are otherwise collected for `events`.
+    """
+
+    TOKEN = 0
+    INT_DIGITS = 1
+    STR_LEN = 2
+    STR_BODY = 3
+
+    MAX_DIGITS = 32
+
+    def __init__(self, callback=None):
+        super().__init__(None)
+        self.callback = callback
+        self.state = self.TOKEN
+        self._stack = []
+        self._keys = []
+        self._digits = bytearray()
+        self._str = bytearray()
+        self._str_left = 0
+        self._complete = deque()
+        self._failed = False
+
+    def feed(self, chunk):
+        """Consume next chunk of input"""
+        if self._failed:
+            raise UnrecognizedTokenError('Decoder is in a failed state')
+        try:
+            self._consume(chunk)
+        except (UnrecognizedTokenError, ValueError) as err:
+            self._failed = True
+            raise UnrecognizedTokenError(str(err))
+
+    def events(self):
+        """Yield top level objects completed so far"""
+        while self._complete:
+            yield self._complete.popleft()
+
+    def close(self):
+        """Signal end of input, fails if an object is still incomplete"""
+        if self.state != self.TOKEN or self._stack:
+            raise UnrecognizedTokenError('Input ended inside an object')
+
+    def _consume(self, chunk):
+        view = memoryview(chunk)
+        pos, size = 0, len(chunk)
+        while pos < size:
+            if self.state == self.STR_BODY:
+                take = min(self._str_left, size - pos)
+                self._str += view[pos: pos + take]
+                self._str_left -= take
+                pos += take
+                if not self._str_left:
+                    self.state = self.TOKEN
+                    self._add(bytes(self._str))
+                    self._str.clear()
+            elif self.state != self.TOKEN:
+                terminator = b'e' if self.state == self.INT_DIGITS else b':'
+                end = chunk.find(terminator, pos)
+                if end == -1:
+                    self._digits += view[pos:]
+                    if len(self._digits) > self.MAX_DIGITS:
+                        raise UnrecognizedTokenError('Number too long')
+                    break
+                self._digits += view[pos: end]
+                pos = end + 1
+                if self.state == self.INT_DIGITS:
+                    self.state = self.TOKEN
+                    self._add(self.parse_int(self._digits))
+                else:
+                    self._str_left = self.parse_len(self._digits)
+                    self.state = self.STR_BODY
+                    if not self._str_left:
+                        self.state = self.TOKEN
+                        self._add(b'')
+                self._digits.clear()
+            else:
+                token = chunk[pos]
+                if 48 <= token <= 57:
+                    self.state = self.STR_LEN
+                    continue
+                pos += 1
+                if token == OrderedDecoder._INT:
+                    self.state = self.INT_DIGITS
+                elif token == OrderedDecoder._LIST:
+                    self._stack.append([])
+                    self._keys.append(OrderedDecoder._NO_KEY)
+                elif token == OrderedDecoder._DICT:
+                    self._stack.append(OrderedDict())
+                    self._keys.append(OrderedDecoder._NO_KEY)
+                elif (token == OrderedDecoder._END and self._stack and
+                      self._keys[-1] is OrderedDecoder._NO_KEY):
+                    self._keys.pop()
+                    self._add(self._stack.pop())
+                else:
+                    raise UnrecognizedTokenError(
+                        'Unexpected token {!r}'.format(chr(token)))
+
+    def _add(self, value):
+        if not self._stack:
+            if self.callback:
+                self.callback(value)
+            else:
+                self._complete.append(value)
+            return
+        parent = self._stack[-1]
+        if type(parent) is list:
+            parent.append(value)
+        elif self._keys[-1] is OrderedDecoder._NO_KEY:
+            if type(value) is not bytes:
+                raise UnrecognizedTokenError('Dictionary key must be a string')
+            self._keys[-1] = value
+        else:
+            parent[self._keys[-1]] = value
+            self._keys[-1] = OrderedDecoder._NO_KEY
 
 
 class OrderedEncoder(BaseDecoderEncoder):
 
     def encode(self):
         """Encoding symbolic start method"""
-        return self.encode_entity(self.data)
-
-    def encode_entity(self, ent):
-        """The real encoding deal"""
-        if type(ent) is bytes and all(el in b'0123456789' for el in ent):
-            return b'i' + ent + b'e'
-        else:
-            start_b, end_b = self.encode_info[type(ent)]
-            data = b''
-            if type(ent) is OrderedDict:
-                for key, val in ent.items():
-                    data += self.encode_entity(key)
-                    data += self.encode_entity(val)
-            elif type(ent) is list:
-                for el in ent:
-                    data += self.encode_entity(el)
-            else:
-                return str(len(ent)).encode('utf-8') + b':' + ent
-            return start_b + data + end_b
-
-
-class Block:
-    """Integral part of the piece as a whole"""
-
-    MISSING = 1
-    PROCESSING = 2
-    COMPLETE = 3
-
-    def __init__(self, length, offset):
-        self.length = length
-        self.offset = offset
-        self.state = self.MISSING
-        self.data = bytearray()
-
-    def fill_block_with_data(self, data: bytes):
-        if len(self.data) == self.length:
-            self.data.extend(data)
-            self.state = self.COMPLETE
+        out = bytearray()
+        self.encode_entity(self.data, out)
+        return bytes(out)
+
+    def encode_entity(self, ent, out):
+        """Append bencoded entity to the `out` buffer"""
+        if isinstance(ent, int):
+            out += b'i%de' % ent
+        elif isinstance(ent, (bytes, bytearray)):
+            out += b'%d:' % len(ent)
+            out += ent
+        elif isinstance(ent, list):
+            out += self.LIST
+            for el in ent:
+                self.encode_entity(el, out)
+            out += self.END
+        elif isinstance(ent, dict):
+            out += self.DICT
+            for key, val in ent.items():
+                self.encode_entity(key, out)
+                self.encode_entity(val, out)
+            out += self.END
         else:
-            self.state = self.MISSING
+            raise TypeError('Cannot bencode {}'.format(type(ent).__name__))
 
 
 class Piece:
-    """A sum of a number of blocks"""
+    """
+    Data of a piece in flight, block states are kept in BlockStates
+    """
 
-    REQ_SIZE = 2**14  # 16KB block (stated as optimal in wiki)
+    REQ_SIZE = BlockStates.BLOCK_SIZE
 
-    def __init__(self, length, sha1):
+    def __init__(self, length, sha1, buffer):
         self.length = length
         self.sha1 = sha1
-        if self.length % self.REQ_SIZE:
-            self.nr_blocks = self.length // self.REQ_SIZE + 1
-            modify_last_block = True
-        else:
-            self.nr_blocks = self.length // self.REQ_SIZE
-            modify_last_block = False
-        self.blocks = [Block(self.REQ_SIZE, self.REQ_SIZE * i) for i in range(self.nr_blocks)]
-        if modify_last_block:
-            self.blocks[-1].length -= self.length - (self.length % self.REQ_SIZE)
-        self.left = self.length
+        self.buffer = buffer
+        self.data = memoryview(buffer)[:length]
 
-    def missing_blocks(self):
-        return {block for block in self.blocks if block.state == block.MISSING}
+    def fill_block_with_data(self, offset, data: bytes):
+        self.data[offset: offset + len(data)] = data
 
-    def pending_blocks(self):
-        return {block for block in self.blocks if block.state == block.PROCESSING}
-
-    def is_complete(self):
-        return all(block.state == block.COMPLETE for block in self.blocks) and self.check_integrity()
+    def block_view(self, offset, length):
+        """Writable view of the block for receiving straight into it"""
+        return self.data[offset: offset + length]
 
     @property
     def complete_raw_data(self):
-        data = bytearray()
-        for block in self.blocks:
-            data.extend(block.data)
-        return data
+        return self.data
 
     def check_integrity(self):
-        return hashlib.sha1(self.complete_raw_data()).digest() == self.sha1
+        return hashlib.sha1(self.data).digest() == self.sha1
 
 
 class AutoFillQueue(queue.Queue):
@@ -239,73 +346,509 @@ class AutoFillQueue(queue.Queue):
 
 
 class PieceManager(threading.Thread):
-
-    def __init__(self, torrent, pieces: dict, *args,
-                 pieces_data_queue=None,
+    """
+    Owner of the download state, driven by events posted from peers,
+    the hash verifier and the disk writer. The thread sleeps in a
+    blocking queue get while nothing happens.
+    """
+
+    BLOCK_RECEIVED = 'block_received'
+    PIECE_VERIFIED = 'piece_verified'
+    PIECE_WRITTEN = 'piece_written'
+    PEER_PIECES_CHANGED = 'peer_pieces_changed'
+    PEER_UNCHOKED = 'peer_unchoked'
+    REQUEST_SLOT_FREED = 'request_slot_freed'
+    REQUESTS_DROPPED = 'requests_dropped'
+    TERMINATE = 'terminate'
+
+    RESUME_SAVE_INTERVAL = 30
+    MAINTENANCE_INTERVAL = 5
+    # peers with at most this many wanted pieces get them picked from
+    # their bitfield instead of a walk over the picker buckets
+    SPARSE_PICK = 256
+
+    # endgame: a block is requested from at most this many peers and
+    # duplicate requests in flight never exceed the byte budget
+    ENDGAME_MAX_COPIES = 3
+    ENDGAME_DUPLICATE_BUDGET = 2**23
+
+    def __init__(self, torrent, pieces: PieceTable, *args,
+                 events=None,
                  pieces_have_queue=None,
                  **kwargs):
 
         super().__init__(*args, **kwargs)
+        self.torrent = torrent
         self.pieces = pieces
-        self.pieces_data_queue = pieces_data_queue
+        self.states = torrent.block_states
+        self.storage = torrent.storage
+        self.resume = torrent.resume
+        self.resume_dirty = False
+        self.last_resume_save = time.monotonic()
+        self.next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+        self.events = events
         self.pieces_have_queue = pieces_have_queue
         self.peers_pieces_queues = PiecesPeersTransportFactory.produce(torrent)
         self.pieces_lock = threading.Lock()
+        self.picker = PiecePicker(len(pieces))
+        for piece_ind in iter_set_bits(pieces.have, len(pieces)):
+            self.picker.mark_have(piece_ind)
+        # peers whose pieces are counted in the picker availability
+        self.counted_peers = set()
+        self.verifier = HashVerifier(
+            functools.partial(self.post, self.PIECE_VERIFIED))
+        self.disk = storage.DiskWriter(
+            self.storage, functools.partial(self.post, self.PIECE_WRITTEN))
+        # disk writes already covered by a status report
+        self.reported_writes = 0
+        # piece index -> peers which sent blocks of it
+        self.contributors = {}
+        # peer -> number of pieces it took part in that failed the check
+        self.hash_failures = Counter()
+        # (piece index, block index) -> peers the block was queued for
+        self.requesters = {}
+        # (piece index, block offset) -> peer whose copy of the block
+        # is being received into the piece buffer
+        self.landings = {}
+        self.endgame = False
+        self.duplicate_in_flight = 0
+        self.endgame_stats = Counter()
         self.current_piece_ind = 0
         self._terminate = False
 
     def terminate(self):
         self._terminate = True
+        self.verifier.stop()
+        self.disk.terminate()
+        self.post(self.TERMINATE)
+
+    def post(self, kind, *args):
+        """Hand an event over to the manager thread"""
+        self.events.put((kind, args))
 
     def get_piece_info_for_request(self, piece_ind=None, peer=None):
+        # not holding pieces_lock here, the queue is filled under it
+        request = self.peers_pieces_queues[peer].get()
+        self.post(self.REQUEST_SLOT_FREED, peer)
+        return request
+
+    def next_request(self, peer):
+        """
+        Non blocking variant of the above, None when nothing is queued.
+        Skips requests for blocks which arrived from another peer
+        while waiting in the queue (endgame).
+        """
+        try:
+            piece_queue = self.peers_pieces_queues[peer]
+        except KeyError:
+            return None
+        while True:
+            try:
+                request = piece_queue.get_nowait()
+            except queue.Empty:
+                return None
+            self.post(self.REQUEST_SLOT_FREED, peer)
+            if not self.endgame or self.still_wanted(peer, *request):
+                return request
+
+    def still_wanted(self, peer, piece_ind, block_offset, block_len):
         with self.pieces_lock:
-            # if piece_ind:
-            #     piece_of_interest = self.pieces[piece_ind]
-            # else:
-            #     piece_of_interest = self.pieces[self.current_piece_ind]
-            # if piece_of_interest.is_complete() and not piece_ind:
-            #     self.current_piece_ind += 1
-            #     return self.get_piece_info_for_request(piece_ind)
-            # for block in piece_of_interest.blocks:
-            #     if block.MISSING:
-            #         return self.current_piece_ind, block.offset, block.length
-            return self.peers_pieces_queues[peer].get()
+            block_ind = self.states.block_of(piece_ind, block_offset,
+                                             block_len)
+            return block_ind is not None and \
+                peer in self.requesters.get((piece_ind, block_ind), ())
 
     def run(self):
-        if any(q is None for q in (self.pieces_data_queue,
-                                   self.pieces_have_queue)):
+        if any(q is None for q in (self.events, self.pieces_have_queue)):
             raise RuntimeError('Queues for piece management not set!')
+        handlers = {
+            self.BLOCK_RECEIVED: self.on_block_received,
+            self.PIECE_VERIFIED: self.on_piece_verified,
+            self.PIECE_WRITTEN: self.on_piece_written,
+            self.PEER_PIECES_CHANGED: self.schedule,
+            self.PEER_UNCHOKED: self.schedule,
+            self.REQUEST_SLOT_FREED: self.schedule,
+            self.REQUESTS_DROPPED: self.on_requests_dropped,
+            self.TERMINATE: lambda: None,
+        }
+        self.verifier.start()
+        self.disk.start()
         while not self._terminate:
+            timeout = max(0, self.next_maintenance - time.monotonic())
             try:
-                data = self.pieces_data_queue.get(False)
+                kind, args = self.events.get(timeout=timeout)
             except queue.Empty:
-                # print('No data in peer queue atm')
                 pass
             else:
-                piece_ind, block_offset, block_data = data
-                with self.pieces_lock:
-                    piece = self.pieces[piece_ind]
-                    for block in self.pieces[piece_ind]:
-                        if block_offset == block.offset:
-                            block.fill_block_with_data(block_data)
-                            break
-                        if piece.is_complete():
-                            print(piece, piece.complete_raw_data)
-                            self.current_piece_ind += 1
-                            self.pieces_have_queue.put(piece_ind)
-
-            with self.peers_pieces_queues.lock:
-                for peer in self.peers_pieces_queues:
-                    piece_queue = self.peers_pieces_queues[peer]
-                    for piece_ind in peer.get_pieces_inds_peer_has():
-                        piece = self.pieces[piece_ind]
-                        if not piece.is_complete():
-                            for block in piece.missing_blocks():
-                                try:
-                                    piece_queue.put((piece_ind, block.offset, block.length))
-                                except queue.Full:
-                                    break
-                            break
+                handlers[kind](*args)
+            if time.monotonic() >= self.next_maintenance:
+                self.maintenance()
+
+        self.disk.join()
+        self.save_resume()
+
+    def on_block_received(self, piece_ind, block_offset, block_len, peer=None):
+        with self.pieces_lock:
+            self.block_received(piece_ind, block_offset, block_len, peer)
+        if peer is not None:
+            self.schedule(peer)
+
+    def on_piece_verified(self, piece_ind, is_valid):
+        with self.pieces_lock:
+            self.piece_verified(piece_ind, is_valid)
+        if not is_valid:
+            self.schedule()
+
+    def on_piece_written(self, piece_ind, error):
+        with self.pieces_lock:
+            self.piece_written(piece_ind, error)
+        # every write frees a buffer and disk budget, and schedule
+        # gave up on any event while the disk was over budget
+        self.schedule()
+
+    def on_requests_dropped(self, peer, requests, gone=False):
+        """
+        Requests the peer will not serve (choke, disconnect) are missing
+        again, so are those still waiting in its queue. The queue is
+        emptied here, on the thread filling it, so no request put in it
+        meanwhile gets lost.
+        """
+        with self.pieces_lock:
+            if gone:
+                requests += self.peers_pieces_queues.unregister(peer)
+                # a block cut off mid transfer
+                for key, owner in list(self.landings.items()):
+                    if owner is peer:
+                        del self.landings[key]
+            else:
+                requests += self.peers_pieces_queues.drain(peer)
+            for piece_ind, block_offset, block_len in requests:
+                block_ind = self.states.block_of(piece_ind, block_offset,
+                                                 block_len)
+                if block_ind is not None and not self.forget_requester(
+                        piece_ind, block_ind, peer):
+                    # nobody else was asked for it either
+                    self.states.mark_missing(piece_ind, block_ind)
+        self.schedule()
+
+    def maintenance(self):
+        """
+        Periodic work: evict idle pieces, save resume data and report
+        the disk stage
+        """
+        self.next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+        with self.pieces_lock:
+            evicted = self.pieces.evict_idle(
+                busy={piece_ind for piece_ind, _ in self.landings})
+            for piece_ind in evicted:
+                self.reset_piece(piece_ind)
+                self.contributors.pop(piece_ind, None)
+        if evicted:
+            self.schedule()
+        if self.resume_dirty and time.monotonic() - \
+                self.last_resume_save > self.RESUME_SAVE_INTERVAL:
+            self.save_resume()
+        self.report_disk()
+
+    def report_disk(self):
+        """Print disk writer figures if it wrote since the last report"""
+        stats = self.disk.stats()
+        if stats['writes'] == self.reported_writes and \
+                not stats['queue_depth']:
+            return
+        self.reported_writes = stats['writes']
+        print('Disk: {} queued ({:.1f} MB pending), {:.1f} MB/s, '
+              'write latency {:.1f} ms avg {:.1f} ms max, {} fsyncs'.format(
+                  stats['queue_depth'], stats['pending_bytes'] / 2**20,
+                  stats['bytes_per_sec'] / 2**20,
+                  stats['avg_write_latency'] * 1000,
+                  stats['max_write_latency'] * 1000, stats['fsyncs']))
+
+    def schedule(self, peer=None, piece_inds=None):
+        """
+        Top up request queues of the peer, or of every peer. With
+        `piece_inds` (a Have) only those pieces are considered.
+        """
+        if self.disk.over_budget():
+            # disk is behind, let it catch up before asking for more
+            return
+        with self.peers_pieces_queues.lock:
+            peers = [peer] if peer is not None else list(self.peers_pieces_queues)
+        for peer in peers:
+            if getattr(peer, 'peer_choking', False):
+                continue
+            try:
+                piece_queue = self.peers_pieces_queues[peer]
+            except KeyError:
+                continue
+            queued = False
+            with self.pieces_lock:
+                room = piece_queue.maxsize - piece_queue.qsize() \
+                    if piece_queue.maxsize > 0 else None
+                for piece_ind in self.pieces_for(peer, piece_inds, room):
+                    if piece_queue.full():
+                        break
+                    queued |= self.fill_requests(piece_ind, piece_queue, peer)
+                if self.update_endgame() and not piece_queue.full():
+                    queued |= self.fill_endgame(peer, piece_queue)
+            if queued:
+                self.peers_pieces_queues.notify(peer)
+
+    def pieces_for(self, peer, piece_inds=None, room=None):
+        """
+        Candidate pieces to request from the peer, started pieces with
+        blocks left first so they complete, then rarest first. New
+        pieces are only offered while a buffer is left to start them,
+        and no more of them than the `room` left in the peer queue.
+        """
+        if piece_inds is not None:
+            active = [piece_ind for piece_ind in piece_inds
+                      if piece_ind in self.states.partial]
+            fresh = self.picker.pick_among(piece_inds)
+        else:
+            active = list(self.states.partial)
+            fresh = None
+        for piece_ind in active:
+            if peer.has_piece(piece_ind) and self.states.missing(piece_ind):
+                yield piece_ind
+        if fresh is None:
+            if not self.picker.has_wanted():
+                return
+            # pieces of the peer neither had nor in flight, the count
+            # is an upper bound which does as the limit of the walk
+            wanted = peer.pieces.missing_from(self.pieces.have)
+            nr_wanted = wanted.count()
+            in_flight = self.pieces.active
+            if nr_wanted <= len(in_flight) and all(
+                    piece_ind in in_flight for piece_ind in wanted.indices()):
+                return
+            if nr_wanted <= self.SPARSE_PICK:
+                fresh = self.picker.pick_among(wanted.indices())
+            else:
+                # a new piece takes a buffer and at least one queue slot
+                limit = min(nr_wanted, self.pieces.buffer_pool.nr_available())
+                if room is not None:
+                    limit = min(limit, room)
+                fresh = self.picker.pick(peer.has_piece, limit)
+        for piece_ind in fresh:
+            if not self.pieces.buffer_pool.available():
+                return
+            yield piece_ind
+
+    def peer_has(self, peer, piece_inds):
+        """Count newly announced pieces of the peer in availability"""
+        with self.pieces_lock:
+            self.counted_peers.add(peer)
+            for piece_ind in piece_inds:
+                self.picker.peer_has(piece_ind)
+        # after a Have only the announced piece is worth looking at
+        self.post(self.PEER_PIECES_CHANGED, peer,
+                  piece_inds if len(piece_inds) == 1 else None)
+
+    def peer_gone(self, peer):
+        """Drop pieces of a disconnected (or re-announcing) peer"""
+        with self.pieces_lock:
+            if peer not in self.counted_peers:
+                return
+            self.counted_peers.discard(peer)
+            for piece_ind in peer.get_pieces_inds_peer_has():
+                self.picker.peer_lost(piece_ind)
+
+    def block_buffer(self, piece_ind, block_offset, block_len, peer=None):
+        """
+        Memory the block should be received into, None if the block
+        is not wanted (not requested from the peer, bad offsets, no
+        free buffers, another copy of it is being received). The piece
+        buffer stays reserved for the peer until it reports the block
+        received.
+        """
+        with self.pieces_lock:
+            if (piece_ind, block_offset) in self.landings:
+                return None
+            if not 0 <= piece_ind < len(self.pieces) or \
+                    self.pieces.has(piece_ind):
+                return None
+            block_ind = self.states.block_of(piece_ind, block_offset,
+                                             block_len)
+            # unsolicited blocks must not take buffers from the pool
+            if block_ind is None or self.states.state(
+                    piece_ind, block_ind) != self.states.REQUESTED:
+                return None
+            if peer is not None and peer not in self.requesters.get(
+                    (piece_ind, block_ind), ()):
+                return None
+            piece = self.pieces[piece_ind]
+            if piece is None:
+                return None
+            self.landings[piece_ind, block_offset] = peer
+            return piece.block_view(block_offset, block_len)
+
+    def block_received(self, piece_ind, block_offset, block_len, peer=None):
+        """
+        Account block landed in its piece, hand the piece over
+        for verification once all of its blocks are in
+        """
+        if self.landings.get((piece_ind, block_offset), 0) is peer:
+            del self.landings[piece_ind, block_offset]
+        if self.pieces.has(piece_ind) or self.pieces.peek(piece_ind) is None:
+            return
+        block_ind = self.states.block_of(piece_ind, block_offset, block_len)
+        if block_ind is None or not self.states.mark_received(piece_ind,
+                                                               block_ind):
+            return
+        self.cancel_duplicates(piece_ind, block_ind, block_len, peer)
+        piece = self.pieces[piece_ind]
+        self.contributors.setdefault(piece_ind, set()).add(peer)
+        if self.states.is_complete(piece_ind):
+            self.pieces.pin(piece_ind)
+            self.verifier.submit(piece_ind, piece)
+
+    def piece_verified(self, piece_ind, is_valid):
+        """Handle hash check result of a completed piece"""
+        contributors = self.contributors.pop(piece_ind, set())
+        if is_valid:
+            self.disk.submit(piece_ind, self.pieces.peek(piece_ind).data)
+        else:
+            for peer in contributors - {None}:
+                self.hash_failures[peer] += 1
+            self.pieces.release(piece_ind)
+            self.reset_piece(piece_ind)
+
+    def piece_written(self, piece_ind, error):
+        """Piece reached the disk, it can be announced and its buffer reused"""
+        if error:
+            print('Failed writing piece {}: {}'.format(piece_ind, error))
+            self.pieces.release(piece_ind)
+            self.reset_piece(piece_ind)
+            return
+        self.pieces.mark_have(piece_ind)
+        self.picker.mark_have(piece_ind)
+        self.torrent.piece_completed(piece_ind)
+        self.resume_dirty = True
+        self.current_piece_ind += 1
+        self.pieces_have_queue.put(piece_ind)
+
+    def save_resume(self):
+        with self.pieces_lock:
+            bitfield = bytes(self.pieces.have)
+            self.resume_dirty = False
+        self.last_resume_save = time.monotonic()
+        try:
+            self.resume.save(bitfield)
+        except OSError as err:
+            print('Could not save resume data: {}'.format(err))
+
+    def fill_requests(self, piece_ind, piece_queue, peer=None):
+        """
+        Queue missing blocks of the piece for a peer, returns True
+        if anything was queued
+        """
+        queued = False
+        block_ind = self.states.next_missing(piece_ind)
+        if block_ind is None or piece_queue.full() or \
+                not self.pieces.can_start(piece_ind) or \
+                self.pieces[piece_ind] is None:
+            return queued
+        self.picker.mark_started(piece_ind)
+        while block_ind is not None and not piece_queue.full():
+            piece_queue.put_nowait((
+                piece_ind,
+                block_ind * self.states.block_size,
+                self.states.block_length(piece_ind, block_ind)
+            ))
+            self.states.mark_requested(piece_ind, block_ind)
+            self.requesters[piece_ind, block_ind] = {peer}
+            queued = True
+            block_ind = self.states.next_missing(piece_ind)
+        return queued
+
+    def reset_piece(self, piece_ind):
+        """Forget all blocks of the piece, they are missing again"""
+        for block_ind in range(self.states.blocks_in(piece_ind)):
+            self.drop_requesters(piece_ind, block_ind)
+        self.states.reset_piece(piece_ind)
+        if not self.pieces.has(piece_ind):
+            self.picker.mark_wanted(piece_ind)
+
+    def drop_requesters(self, piece_ind, block_ind):
+        """Stop tracking who the block was requested from"""
+        peers = self.requesters.pop((piece_ind, block_ind), ())
+        if len(peers) > 1:
+            self.duplicate_in_flight -= (len(peers) - 1) * \
+                self.states.block_length(piece_ind, block_ind)
+        return peers
+
+    def forget_requester(self, piece_ind, block_ind, peer):
+        """
+        The peer will not deliver the block, returns True if
+        it is still requested from other peers
+        """
+        peers = self.requesters.get((piece_ind, block_ind))
+        if not peers or peer not in peers:
+            return bool(peers)
+        if len(peers) == 1:
+            del self.requesters[piece_ind, block_ind]
+            return False
+        peers.discard(peer)
+        self.duplicate_in_flight -= self.states.block_length(piece_ind,
+                                                             block_ind)
+        return True
+
+    def update_endgame(self):
+        """
+        Endgame starts once every remaining block is requested, from
+        then on blocks get requested from several peers at once
+        """
+        endgame = self.states.all_requested()
+        if endgame != self.endgame:
+            self.endgame = endgame
+            if endgame:
+                self.endgame_stats['started'] += 1
+                print('Endgame started, {} blocks in flight'.format(
+                    len(self.requesters)))
+            else:
+                print('Endgame over: {}'.format(dict(self.endgame_stats)))
+        return endgame
+
+    def fill_endgame(self, peer, piece_queue):
+        """
+        Queue duplicates of blocks in flight for the peer, oldest
+        requests first, returns True if anything was queued
+        """
+        queued = False
+        if piece_queue.full():
+            return queued
+        for (piece_ind, block_ind), peers in self.requesters.items():
+            if peer in peers or len(peers) >= self.ENDGAME_MAX_COPIES or \
+                    not peer.has_piece(piece_ind):
+                continue
+            block_len = self.states.block_length(piece_ind, block_ind)
+            if self.duplicate_in_flight + block_len > \
+                    self.ENDGAME_DUPLICATE_BUDGET:
+                self.endgame_stats['budget_exhausted'] += 1
+                break
+            piece_queue.put_nowait((
+                piece_ind, block_ind * self.states.block_size, block_len
+            ))
+            peers.add(peer)
+            self.duplicate_in_flight += block_len
+            self.endgame_stats['duplicate_requests'] += 1
+            self.endgame_stats['duplicate_bytes'] += block_len
+            queued = True
+            if piece_queue.full():
+                break
+        return queued
+
+    def cancel_duplicates(self, piece_ind, block_ind, block_len, peer):
+        """First copy of the block arrived, cancel it at the other peers"""
+        request = (piece_ind, block_ind * self.states.block_size, block_len)
+        for other in self.drop_requesters(piece_ind, block_ind):
+            if other is peer or other is None:
+                continue
+            cancel = getattr(other, 'cancel_request', None)
+            if cancel is not None:
+                cancel(request)
+                self.endgame_stats['cancels'] += 1
 
 
 
@@ -318,39 +861,68 @@ class PieceManager(threading.Thread):
 
 class Torrent:
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, download_dir='.'):
         self.torrent = torrent
-        self.data = self.decode_torrent()
-        self.bhash_info = self.encode_torrent(self.data[b'info'])
+        self.data, self.info_hash = self.decode_torrent()
+        self.storage = storage.Storage(self.data[b'info'], download_dir)
 
+        self.peer_id = '-PC0001-' + ''.join(str(random.randint(0, 9))
+                                            for _ in range(12))
         self._downloaded = 0
         self._uploaded = 0
-        self._data_left = self.get_files_length()
-        self.sha_pieces = {
-            ind: self.info[b'pieces'][i: i + 20]
-            for ind, i in enumerate(
-                range(0, len(self.info[b'pieces']), 20)
-            )
-        }
-        self.actual_data = {
-            piece_ind: Piece(int(self.info[b'piece length']),
-                             self.sha_pieces[piece_ind]) for
-            piece_ind in range(len(self.sha_pieces))
-        }
+        self._data_left = self.storage.total_length
+        self.pieces = PieceTable(self.info[b'pieces'],
+                                 int(self.info[b'piece length']),
+                                 self._data_left,
+                                 Piece,
+                                 BufferPool(int(self.info[b'piece length'])))
+        self.block_states = BlockStates(self.pieces)
+        self.resume = storage.ResumeData(self.storage, self.info_hash)
+        self.restore_pieces()
 
         self.pieces_manager = PieceManager(
             self,
-            self.actual_data,
-            pieces_data_queue=queue.Queue(),
+            self.pieces,
+            events=queue.Queue(),
             pieces_have_queue=queue.Queue()
         )
 
 
 
+    def restore_pieces(self):
+        """
+        Mark pieces already on disk as had, from resume data when it
+        is up to date and by rechecking the files otherwise
+        """
+        have = self.resume.load(len(self.pieces.have))
+        if have is None:
+            if not self.storage.has_data():
+                return
+            have = storage.recheck(self.storage, self.pieces)
+        for piece_ind in iter_set_bits(have, len(self.pieces)):
+            self.pieces.mark_have(piece_ind)
+            self.block_states.mark_complete(piece_ind)
+            self._data_left -= self.pieces.length_of(piece_ind)
+
+    def piece_completed(self, piece_ind):
+        """Count a downloaded and stored piece in the tracker stats"""
+        self._downloaded += self.pieces.length_of(piece_ind)
+        self._data_left -= self.pieces.length_of(piece_ind)
+
+    def add_uploaded(self, nbytes):
+        self._uploaded += nbytes
+
     def decode_torrent(self):
-        """Returns decoded torrent metainfo as python types"""
+        """
+        Returns decoded torrent metainfo as python types together
+        with the info-hash, taken over the original bytes of `info`
+        """
         with open(self.torrent, 'rb') as fd:
-            return OrderedDecoder(fd.read()).decode()
+            raw = fd.read()
+        bdecoder = OrderedDecoder(raw, span_keys=(b'info',))
+        data = bdecoder.decode()
+        start, end = bdecoder.spans[b'info']
+        return data, hashlib.sha1(bdecoder.view[start: end]).digest()
 
     def decode_chunks(self, data):
         return OrderedDecoder(data).decode()
@@ -359,10 +931,10 @@ class Torrent:
         return OrderedEncoder(data).encode()
 
     def get_nr_of_pieces(self):
-        return len(self.sha_pieces)
+        return len(self.pieces)
 
     def get_files_length(self):
-        return sum(int(x[b'length']) for x in self.data[b'info'][b'files'])
+        return self.storage.total_length
 
     @staticmethod
     def key_search(key, data):
@@ -401,13 +973,9 @@ class Torrent:
     @property
     def tracker_info_header(self):
         """Returns torrent related info for tracker connection"""
-        info_hash = hashlib.sha1(self.bhash_info).digest()
-        peer_id = '-PC0001-' + ''.join(str(random.randint(0, 9))
-                                       for _ in range(12))
-
         return {
-            'info_hash': info_hash,
-            'peer_id': peer_id,
+            'info_hash': self.info_hash,
+            'peer_id': self.peer_id,
             'uploaded': self.uploaded,
             'downloaded': self.downloaded,
             'left': self.left,
@@ -427,5 +995,5 @@ class Torrent:
 
     # def verify_piece(self, piece, piece_ind):
     #     """Verify assembled piece integrity"""
-    #     assert hashlib.sha1(piece).digest() == self.sha_pieces[piece_ind]
+    #     assert hashlib.sha1(piece).digest() == self.pieces.piece_hash(piece_ind)
 
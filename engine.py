@@ -0,0 +1,876 @@
+import time
+import struct
+import asyncio
+import threading
+from collections import Counter, OrderedDict, deque
+
+import codec
+import decoder
+import entities
+from pieces import Bitset
+from framer import Framer, FramingError
+
+
+class RequestWindow:
+    """
+    Number of requests to keep in flight to a single peer.
+
+    Sized from the bandwidth-delay product of the link: the measured
+    download rate times the smallest round trip seen lately, in blocks,
+    with some headroom so the window keeps growing while the rate does.
+
+    Only requests sent onto an empty pipeline give round trip samples.
+    Any other request also waits in the peer's queue behind our own
+    ones, which would make the estimate follow the window itself.
+    """
+
+    MIN_SIZE = 2
+    MAX_SIZE = 500
+    INITIAL_SIZE = 5
+    HEADROOM = 1.5
+    RATE_INTERVAL = 0.5
+    RTT_RESET_INTERVAL = 10
+
+    def __init__(self, block_size=2**14):
+        self.block_size = block_size
+        self.limit = self.MAX_SIZE
+        self.size = self.INITIAL_SIZE
+        self.rate = 0.0
+        self.min_rtt = None
+        self.rtt_reset = time.monotonic() + self.RTT_RESET_INTERVAL
+        self.rate_start = time.monotonic()
+        self.rate_bytes = 0
+
+    def set_limit(self, limit):
+        """Upper bound advertised by the peer (`reqq`)"""
+        self.limit = max(self.MIN_SIZE, min(self.MAX_SIZE, limit))
+        self.size = min(self.size, self.limit)
+
+    def sample(self, nbytes, rtt, now):
+        """
+        Account a received block, `rtt` is None unless its request was
+        not queued behind others. Returns True if the size changed.
+        """
+        if rtt is not None and (self.min_rtt is None or rtt < self.min_rtt or
+                                now > self.rtt_reset):
+            self.min_rtt = rtt
+            self.rtt_reset = now + self.RTT_RESET_INTERVAL
+        self.rate_bytes += nbytes
+        elapsed = now - self.rate_start
+        if elapsed < self.RATE_INTERVAL:
+            return False
+        current = self.rate_bytes / elapsed
+        # follow increases at once so the window can open up quickly
+        if current > self.rate:
+            self.rate = current
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * current
+        self.rate_start, self.rate_bytes = now, 0
+        if self.min_rtt is None:
+            return False
+
+        bdp = self.rate * self.min_rtt / self.block_size
+        size = max(self.MIN_SIZE, min(self.limit, int(bdp * self.HEADROOM) + 2))
+        changed = size != self.size
+        self.size = size
+        return changed
+
+
+class PeerConnection(asyncio.BufferedProtocol):
+    """
+    Peer wire protocol state machine of a single connection.
+
+    Goes through handshake -> bitfield -> interested -> request/piece.
+    Incoming bytes are framed by a Framer, except for piece payloads
+    which are received straight into the buffer of their piece once
+    the message header is known.
+
+    Requests of an unchoked peer for verified pieces are queued and
+    served by an upload task, which writes the Piece header and sends
+    the block from the torrent files with sendfile.
+    """
+
+    HANDSHAKE = 0
+    ACTIVE = 1
+    CLOSED = 2
+
+    READ_SIZE = 2**16
+    MAX_BLOCK_LEN = 2**17
+    MAX_QUEUED_UPLOADS = RequestWindow.MAX_SIZE
+
+    def __init__(self, engine, address):
+        self.engine = engine
+        self.pieces_manager = engine.pieces_manager
+        self.ip, self.port = address[:2]
+        self.nr_pieces = engine.nr_pieces
+        self.pieces = Bitset(engine.nr_pieces)
+        self.transport = None
+        self.state = self.HANDSHAKE
+        self.peer_choking = True
+        self.peer_interested = False
+        self.am_choking = True
+        self.am_interested = False
+        # request -> time it was sent
+        self.outstanding = {}
+        self.window = RequestWindow()
+        # request sent while nothing else was outstanding, its round
+        # trip is not inflated by our own queue at the peer
+        self.probe = None
+        self.extensions = 0
+        self.framer = Framer(
+            self.READ_SIZE,
+            max(self.MAX_BLOCK_LEN + 9, engine.bitfield_len + 1),
+            split={codec.PIECE: codec.PIECE_HEADER_LEN})
+        self.out = codec.MessageWriter()
+        # (target view, bytes received, request, wanted) of a block
+        # whose payload goes straight into its piece buffer
+        self.landing = None
+        self.scratch = bytearray(self.MAX_BLOCK_LEN)
+        # blocks requested by the peer, served by the upload task
+        self.uploads = deque()
+        self.upload_task = None
+        # (file index, file object) of the file served from last
+        self.upload_file = None
+        # no writes go through the transport while sendfile runs
+        self.sending = False
+        self.last_recv = self.last_sent = time.monotonic()
+
+    def __repr__(self):
+        return '<PeerConnection {}:{}>'.format(self.ip, self.port)
+
+    # piece manager side interface
+
+    def register(self):
+        self.engine.transport_util.register(
+            self, lambda: self.engine.call_soon(self.pump_requests),
+            size=self.window.size)
+
+    def has_piece(self, piece_ind):
+        return self.pieces.has(piece_ind)
+
+    def get_pieces_inds_peer_has(self):
+        return list(self.pieces.indices())
+
+    # asyncio protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.engine.connections.add(self)
+        self.register()
+        self.out.handshake(self.engine.info_hash, self.engine.peer_id,
+                           entities.Handshake.EXTENSION_PROTOCOL)
+        self.flush()
+
+    def connection_lost(self, exc):
+        self.state = self.CLOSED
+        self.engine.connections.discard(self)
+        self.uploads.clear()
+        if not self.am_choking:
+            self.engine.uploading.discard(self)
+            self.engine.fill_upload_slots()
+        if self.upload_task is None:
+            self.close_upload_file()
+        dropped = list(self.outstanding)
+        self.outstanding.clear()
+        self.pieces_manager.peer_gone(self)
+        # the manager drops the request queue, it is the one filling it
+        self.pieces_manager.post(self.pieces_manager.REQUESTS_DROPPED,
+                                 self, dropped, True)
+        self.engine.connector.closed((self.ip, self.port))
+
+    def get_buffer(self, sizehint):
+        if self.landing:
+            target, received = self.landing[:2]
+            return target[received:]
+        return self.framer.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.last_recv = time.monotonic()
+        if self.landing:
+            self.landing[1] += nbytes
+            target, received, request, wanted = self.landing
+            if received == len(target):
+                self.landing = None
+                self.block_done(request, wanted)
+            self.flush()
+            return
+        self.framer.written(nbytes)
+        try:
+            self.process()
+        except (struct.error, ValueError, IndexError, FramingError,
+                decoder.UnrecognizedTokenError) as err:
+            print('Malformed message from', self, err)
+            self.close()
+        self.flush()
+
+    def eof_received(self):
+        self.close()
+
+    def replay(self, data):
+        """Bytes the listener read before handing the connection over"""
+        data = memoryview(data)
+        while data and self.state != self.CLOSED:
+            target = self.get_buffer(-1)
+            nbytes = min(len(target), len(data))
+            target[:nbytes] = data[:nbytes]
+            data = data[nbytes:]
+            self.buffer_updated(nbytes)
+
+    def process(self):
+        dispatch = self.DISPATCH
+        for frame in self.framer.frames():
+            if self.state != self.ACTIVE:
+                if self.state == self.HANDSHAKE:
+                    self.on_handshake(frame)
+                    continue
+                return
+            if frame:
+                dispatch[frame[0]](self, frame)
+                if self.landing:
+                    return
+
+    def on_handshake(self, handshake):
+        if handshake[0] != len(codec.PSTR) or \
+                handshake[1:20] != codec.PSTR or \
+                handshake[28:48] != self.engine.info_hash:
+            self.close()
+            return
+        self.state = self.ACTIVE
+        self.extensions = codec.unpack_reserved(handshake)
+        if self.extensions & entities.Handshake.EXTENSION_PROTOCOL:
+            self.out.extended(entities.Extended.HANDSHAKE_ID,
+                              decoder.OrderedEncoder(OrderedDict([
+                                  (b'm', OrderedDict()),
+                                  (b'reqq', RequestWindow.MAX_SIZE),
+                              ])).encode())
+        with self.pieces_manager.pieces_lock:
+            have = self.engine.torrent.pieces
+            if have.nr_have:
+                self.out.bitfield(have.have)
+
+    def block_done(self, request, wanted):
+        sent = self.outstanding.pop(request, None)
+        if sent is not None:
+            now = time.monotonic()
+            rtt = now - sent if request == self.probe else None
+            if self.window.sample(request[2], rtt, now):
+                self.window_changed()
+        if wanted:
+            self.pieces_manager.post(self.pieces_manager.BLOCK_RECEIVED,
+                                     *request, self)
+        else:
+            self.engine.stats['unwanted_bytes'] += request[2]
+        self.pump_requests()
+
+    # message handlers, called with the whole frame (message id first)
+
+    def on_piece(self, frame):
+        index, begin = codec.unpack_piece_position(frame)
+        block_len = self.framer.body_pending
+        request = (index, begin, block_len)
+        target = self.pieces_manager.block_buffer(index, begin, block_len,
+                                                  self)
+        wanted = target is not None
+        if not wanted:
+            target = memoryview(self.scratch)[:block_len]
+        have = self.framer.read_body(target)
+        if have < block_len:
+            self.landing = [target, have, request, wanted]
+        else:
+            self.block_done(request, wanted)
+
+    def on_choke(self, frame):
+        self.peer_choking = True
+        # the peer discards our pending requests when it chokes us,
+        # queued ones are taken back by the manager
+        dropped = list(self.outstanding)
+        self.outstanding.clear()
+        self.pieces_manager.post(self.pieces_manager.REQUESTS_DROPPED,
+                                 self, dropped, False)
+
+    def on_unchoke(self, frame):
+        self.peer_choking = False
+        self.pieces_manager.post(self.pieces_manager.PEER_UNCHOKED, self)
+        self.pump_requests()
+
+    def on_interested(self, frame):
+        self.peer_interested = True
+        self.engine.fill_upload_slots()
+
+    def on_not_interested(self, frame):
+        self.peer_interested = False
+        if not self.am_choking:
+            self.choke()
+            self.engine.fill_upload_slots()
+
+    def on_request(self, frame):
+        request = codec.unpack_block(frame)
+        if self.am_choking or len(self.uploads) >= self.MAX_QUEUED_UPLOADS:
+            return
+        if not self.can_serve(*request):
+            self.engine.stats['bad_requests'] += 1
+            return
+        self.uploads.append(request)
+        if self.upload_task is None:
+            self.upload_task = self.engine.loop.create_task(self.upload())
+
+    def on_cancel(self, frame):
+        try:
+            self.uploads.remove(codec.unpack_block(frame))
+        except ValueError:
+            pass
+
+    def on_have(self, frame):
+        piece_ind = codec.unpack_index(frame)
+        if self.pieces.set(piece_ind):
+            self.pieces_manager.peer_has(self, (piece_ind,))
+            self.update_interest()
+
+    def on_bitfield(self, frame):
+        self.pieces_manager.peer_gone(self)
+        self.pieces.load(frame[1:])
+        self.pieces_manager.peer_has(self, self.get_pieces_inds_peer_has())
+        self.update_interest()
+
+    def on_extended(self, frame):
+        if frame[1] != entities.Extended.HANDSHAKE_ID:
+            return
+        handshake = decoder.OrderedDecoder(bytes(frame[2:])).decode()
+        reqq = handshake.get(b'reqq') if isinstance(handshake, dict) else None
+        if isinstance(reqq, int) and reqq > 0:
+            self.window.set_limit(reqq)
+            self.window_changed()
+
+    def on_ignored(self, frame):
+        pass
+
+    DISPATCH = codec.dispatch_table({
+        codec.CHOKE: on_choke,
+        codec.UNCHOKE: on_unchoke,
+        codec.INTERESTED: on_interested,
+        codec.NOT_INTERESTED: on_not_interested,
+        codec.HAVE: on_have,
+        codec.BITFIELD: on_bitfield,
+        codec.REQUEST: on_request,
+        codec.PIECE: on_piece,
+        codec.CANCEL: on_cancel,
+        codec.EXTENDED: on_extended,
+    }, on_ignored)
+
+    def window_changed(self):
+        """Let the request queue of the peer follow the window"""
+        if self.engine.transport_util.resize(self, self.window.size):
+            self.pieces_manager.post(self.pieces_manager.REQUEST_SLOT_FREED,
+                                     self)
+
+    def update_interest(self):
+        """Tell the peer whether it has pieces we still need"""
+        interested = self.pieces.has_any_missing_from(
+            self.engine.torrent.pieces.have)
+        if interested != self.am_interested:
+            self.am_interested = interested
+            self.out.message(codec.INTERESTED if interested
+                             else codec.NOT_INTERESTED)
+
+    # outgoing, messages are packed into `out` and written by flush()
+
+    def flush(self):
+        if self.sending or not len(self.out):
+            return
+        data = self.out.flush()
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+            self.last_sent = time.monotonic()
+
+    def pump_requests(self):
+        """Send queued requests while the pipeline has room"""
+        if self.state != self.ACTIVE or self.peer_choking:
+            return
+        now = time.monotonic()
+        while len(self.outstanding) < self.window.size:
+            request = self.pieces_manager.next_request(self)
+            if request is None:
+                break
+            if not self.outstanding:
+                self.probe = request
+            self.outstanding[request] = now
+            self.out.request(*request)
+        self.flush()
+
+    def cancel_request(self, request):
+        """Thread safe, the block arrived from another peer"""
+        self.engine.call_soon(self.send_cancel, request)
+
+    def send_cancel(self, request):
+        if self.outstanding.pop(request, None) is not None:
+            self.out.cancel(*request)
+            self.flush()
+            self.pump_requests()
+
+    def send_have(self, piece_ind):
+        if self.state == self.ACTIVE:
+            self.out.have(piece_ind)
+            self.flush()
+
+    # uploading
+
+    def choke(self):
+        self.am_choking = True
+        self.uploads.clear()
+        self.engine.uploading.discard(self)
+        self.out.message(codec.CHOKE)
+        self.flush()
+
+    def unchoke(self):
+        self.am_choking = False
+        self.engine.uploading.add(self)
+        self.out.message(codec.UNCHOKE)
+        self.flush()
+
+    def can_serve(self, index, begin, length):
+        """Whether the block lies within a piece we have verified"""
+        pieces = self.engine.torrent.pieces
+        return 0 <= index < len(pieces) and pieces.has(index) and \
+            0 < length <= self.MAX_BLOCK_LEN and begin >= 0 and \
+            begin + length <= pieces.length_of(index)
+
+    async def upload(self):
+        """
+        Serve queued requests, block payloads go from the files to the
+        socket with sendfile without passing through Python
+        """
+        storage = self.engine.torrent.storage
+        try:
+            while self.uploads and self.state == self.ACTIVE and \
+                    not self.transport.is_closing():
+                index, begin, length = self.uploads.popleft()
+                self.out.piece_header(index, begin, length)
+                self.flush()
+                self.sending = True
+                try:
+                    for extent in storage.block_extents(index, begin, length):
+                        source = self.file_to_serve(extent.file_ind)
+                        await self.engine.loop.sendfile(
+                            self.transport, source,
+                            extent.file_offset, extent.length)
+                finally:
+                    self.sending = False
+                # messages packed while the block was going out
+                self.flush()
+                self.last_sent = time.monotonic()
+                self.engine.torrent.add_uploaded(length)
+                self.engine.stats['uploaded_bytes'] += length
+        except (OSError, RuntimeError) as err:
+            print('Upload to', self, 'failed', str(err))
+            self.close()
+        finally:
+            self.upload_task = None
+            if self.state == self.CLOSED:
+                self.close_upload_file()
+
+    def file_to_serve(self, file_ind):
+        if self.upload_file is None or self.upload_file[0] != file_ind:
+            self.close_upload_file()
+            self.upload_file = (
+                file_ind, self.engine.torrent.storage.reader(file_ind))
+        return self.upload_file[1]
+
+    def close_upload_file(self):
+        if self.upload_file is not None:
+            self.upload_file[1].close()
+            self.upload_file = None
+
+    def keep_alive(self, now):
+        if now - self.last_recv > self.engine.PEER_TIMEOUT:
+            self.close()
+        elif now - self.last_sent > self.engine.KEEP_ALIVE_INTERVAL:
+            self.out.keep_alive()
+            self.flush()
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+        self.state = self.CLOSED
+
+
+class Connector:
+    """
+    Dials peer addresses on the engine loop.
+
+    At most `max_dials` connects are in progress at once and no dials
+    happen while `max_peers` connections are established. A failed
+    address is retried with exponential backoff and given up on after
+    MAX_FAILURES attempts in a row.
+    """
+
+    BASE_BACKOFF = 5
+    MAX_BACKOFF = 600
+    MAX_FAILURES = 5
+    RECONNECT_DELAY = 30
+
+    def __init__(self, engine, max_dials=32, max_peers=80):
+        self.engine = engine
+        self.max_dials = max_dials
+        self.max_peers = max_peers
+        # address -> time it may be dialed at, in order of arrival
+        self.candidates = OrderedDict()
+        self.failures = {}
+        self.dead = set()
+        self.dialing = set()
+        self.connected = set()
+        self.wakeup = None
+
+    def add(self, addresses):
+        """Thread safe, queue (ip, port) pairs for dialing"""
+        self.engine.ready.wait()
+        self.engine.call_soon(self.add_candidates, list(addresses))
+
+    def add_candidates(self, addresses):
+        now = time.monotonic()
+        for address in addresses:
+            if address in self.dead or address in self.dialing or \
+                    address in self.connected:
+                continue
+            self.candidates.setdefault(address, now)
+        self.wake()
+
+    def closed(self, address):
+        """An established connection to the address went away"""
+        if address in self.connected:
+            self.connected.discard(address)
+            self.candidates[address] = time.monotonic() + self.RECONNECT_DELAY
+        self.wake()
+
+    def wake(self):
+        if self.wakeup:
+            self.wakeup.set()
+
+    def free_slots(self):
+        slots = min(self.max_dials - len(self.dialing),
+                    self.max_peers - len(self.engine.connections) -
+                    len(self.dialing))
+        listener = self.engine.listener
+        if listener:
+            slots = min(slots, listener.max_peers -
+                        listener.nr_connections() - len(self.dialing))
+        return slots
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            next_due = None
+            for address, due in list(self.candidates.items()):
+                if self.free_slots() <= 0:
+                    break
+                if due > now:
+                    next_due = due if next_due is None else min(next_due, due)
+                    continue
+                del self.candidates[address]
+                self.dialing.add(address)
+                self.engine.loop.create_task(self.dial(address))
+            timeout = None if next_due is None else next_due - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dial(self, address):
+        try:
+            await self.engine.connect(*address)
+        except (OSError, asyncio.TimeoutError):
+            failures = self.failures.get(address, 0) + 1
+            self.failures[address] = failures
+            self.engine.stats['dial_failures'] += 1
+            if failures >= self.MAX_FAILURES:
+                self.dead.add(address)
+            else:
+                self.candidates[address] = time.monotonic() + min(
+                    self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** (failures - 1))
+        else:
+            self.failures.pop(address, None)
+            self.connected.add(address)
+            self.engine.stats['dials'] += 1
+        finally:
+            self.dialing.discard(address)
+            self.wake()
+
+
+class InboundHandshake(asyncio.Protocol):
+    """
+    First stage of an accepted connection: reads the handshake only,
+    then hands the connection to the engine of its info hash. Nothing
+    per peer is allocated for connections that get rejected.
+    """
+
+    TIMEOUT = 10
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.transport = None
+        self.data = bytearray()
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.listener.full():
+            self.listener.stats['rejected_full'] += 1
+            transport.abort()
+            return
+        self.timer = asyncio.get_running_loop().call_later(
+            self.TIMEOUT, transport.abort)
+
+    def connection_lost(self, exc):
+        if self.timer:
+            self.timer.cancel()
+
+    def data_received(self, data):
+        self.data += data
+        if self.data[0] != len(codec.PSTR):
+            self.listener.stats['rejected_handshake'] += 1
+            self.transport.abort()
+            return
+        needed = Framer.HANDSHAKE_FIXED_LEN + self.data[0]
+        if len(self.data) < needed:
+            return
+        self.timer.cancel()
+        engine = self.listener.engine_for(self.data[:needed])
+        if engine is None:
+            self.transport.abort()
+            return
+        engine.stats['accepted'] += 1
+        address = self.transport.get_extra_info('peername')
+        if engine.loop is asyncio.get_running_loop():
+            conn = PeerConnection(engine, address)
+            self.transport.set_protocol(conn)
+            conn.connection_made(self.transport)
+            conn.replay(self.data)
+        else:
+            # the torrent runs on another loop, move the socket over
+            self.transport.pause_reading()
+            sock = self.transport.get_extra_info('socket').dup()
+            self.transport.abort()
+            engine.call_soon(engine.attach_socket_soon, sock,
+                             bytes(self.data))
+
+
+class Listener:
+    """
+    Accepts inbound peer connections on one port for every torrent.
+
+    Runs on the loop of the first engine that starts listening, when
+    that torrent stops another one takes the port over. An accepted
+    connection is dropped right away while `max_peers` connections
+    are established over all torrents, and after the handshake if its
+    torrent is unknown or at its own peer limit.
+    """
+
+    PORTS = {}
+    PORTS_LOCK = threading.Lock()
+
+    BACKLOG = 128
+    MAX_PEERS = 500
+
+    def __init__(self, port, max_peers=MAX_PEERS):
+        self.port = port
+        self.max_peers = max_peers
+        self.lock = threading.Lock()
+        # info hash -> engine
+        self.engines = {}
+        # engine whose loop serves the port
+        self.host = None
+        self.server = None
+        self.stats = Counter()
+
+    @classmethod
+    def on_port(cls, port):
+        """The listener of the port, shared by all torrents"""
+        with cls.PORTS_LOCK:
+            listener = cls.PORTS.get(port)
+            if listener is None:
+                listener = cls.PORTS[port] = cls(port)
+            return listener
+
+    def nr_connections(self):
+        with self.lock:
+            engines = list(self.engines.values())
+        return sum(len(engine.connections) for engine in engines)
+
+    def full(self):
+        return self.nr_connections() >= self.max_peers
+
+    def engine_for(self, handshake):
+        """Engine taking a connection with this handshake, or None"""
+        if handshake[0] != len(codec.PSTR) or handshake[1:20] != codec.PSTR:
+            self.stats['rejected_handshake'] += 1
+            return None
+        with self.lock:
+            engine = self.engines.get(bytes(handshake[28:48]))
+        if engine is None:
+            self.stats['rejected_torrent'] += 1
+            return None
+        if not engine.accepting():
+            engine.stats['rejected_full'] += 1
+            return None
+        return engine
+
+    async def add(self, engine):
+        """Serve the torrent of the engine, listening if not yet"""
+        with self.lock:
+            self.engines[engine.info_hash] = engine
+            if self.host is not None:
+                return
+            self.host = engine
+        await self.serve(engine)
+
+    async def serve(self, engine):
+        """Listen on the loop of `engine`, the new host"""
+        try:
+            server = await engine.loop.create_server(
+                lambda: InboundHandshake(self), port=self.port,
+                reuse_address=True, backlog=self.BACKLOG)
+        except OSError as err:
+            print('Could not listen on port', self.port, str(err))
+            with self.lock:
+                if self.host is engine:
+                    self.host = None
+            return
+        with self.lock:
+            if self.host is engine:
+                self.server = server
+                return
+        # the engine stopped meanwhile and handed the port on
+        server.close()
+
+    def remove(self, engine):
+        """Stop serving the torrent, handing the port on if hosting"""
+        with self.lock:
+            self.engines.pop(engine.info_hash, None)
+            if self.host is not engine:
+                return
+            server, self.server = self.server, None
+            host = self.host = next(iter(self.engines.values()), None)
+        if server:
+            server.close()
+        if host is not None:
+            host.call_soon(host.loop.create_task, self.serve(host))
+
+
+class WireEngine(threading.Thread):
+    """
+    Runs all peer connections of a torrent on one asyncio event loop.
+
+    Outbound connections are dialed by the `connector`, inbound ones
+    arrive through the `listener`. New pieces to announce come on the
+    pieces manager `pieces_have_queue`.
+    """
+
+    KEEP_ALIVE_INTERVAL = 90
+    PEER_TIMEOUT = 180
+    CONNECT_TIMEOUT = 10
+    UPLOAD_SLOTS = 8
+
+    def __init__(self, torrent, peer_id, transport_util,
+                 max_dials=32, max_peers=80, listener=None):
+        super().__init__(daemon=True)
+        self.torrent = torrent
+        self.pieces_manager = torrent.pieces_manager
+        self.peer_id = peer_id
+        self.info_hash = torrent.info_hash
+        self.nr_pieces = len(torrent.pieces)
+        self.bitfield_len = (self.nr_pieces + 7) // 8
+        self.transport_util = transport_util
+        self.connections = set()
+        self.stats = Counter()
+        self.connector = Connector(self, max_dials, max_peers)
+        self.listener = listener
+        # unchoked peers, at most UPLOAD_SLOTS
+        self.uploading = set()
+        self.loop = None
+        self.ready = threading.Event()
+        self.stopped = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.watch_queue(self.pieces_manager.pieces_have_queue,
+                         self.broadcast_have)
+        tasks = [self.loop.create_task(self.keep_alive()),
+                 self.loop.create_task(self.connector.run())]
+        if self.listener:
+            await self.listener.add(self)
+        self.ready.set()
+        await self.stopped.wait()
+        if self.listener:
+            self.listener.remove(self)
+        for task in tasks:
+            task.cancel()
+        for conn in list(self.connections):
+            conn.close()
+
+    def call_soon(self, callback, *args):
+        """Thread safe scheduling of a callback on the engine loop"""
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def watch_queue(self, source, callback):
+        """Forward items of a blocking queue to the loop"""
+        def forward():
+            while True:
+                self.call_soon(callback, source.get())
+        threading.Thread(target=forward, daemon=True).start()
+
+    def accepting(self):
+        """Whether an inbound connection may be taken"""
+        return len(self.connections) < self.connector.max_peers
+
+    def attach_socket_soon(self, sock, data=b''):
+        self.loop.create_task(self.attach_socket(sock, data))
+
+    async def attach_socket(self, sock, data=b''):
+        """Take over `sock`, `data` was already read from it"""
+        try:
+            address = sock.getpeername()
+            _, conn = await self.loop.create_connection(
+                lambda: PeerConnection(self, address), sock=sock)
+        except OSError as err:
+            print('Could not attach peer socket', str(err))
+            sock.close()
+            return
+        if data:
+            conn.replay(data)
+
+    async def connect(self, ip, port):
+        """Open an outbound connection, raises OSError on failure"""
+        await asyncio.wait_for(
+            self.loop.create_connection(
+                lambda: PeerConnection(self, (ip, port)), ip, port),
+            self.CONNECT_TIMEOUT)
+
+    def fill_upload_slots(self):
+        """Unchoke interested peers while upload slots are free"""
+        for conn in list(self.connections):
+            if len(self.uploading) >= self.UPLOAD_SLOTS:
+                return
+            if conn.peer_interested and conn.am_choking and \
+                    conn.state == conn.ACTIVE:
+                conn.unchoke()
+
+    def broadcast_have(self, piece_ind):
+        for conn in list(self.connections):
+            conn.send_have(piece_ind)
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(self.KEEP_ALIVE_INTERVAL / 3)
+            now = time.monotonic()
+            for conn in list(self.connections):
+                conn.keep_alive(now)
+
+    def terminate(self):
+        if self.stopped:
+            self.call_soon(self.stopped.set)
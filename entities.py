@@ -1,134 +1,57 @@
 import sys
-import json
 import time
-import queue
-import select
+import random
 import socket
 import struct
 import threading
-import traceback
 from collections import OrderedDict
-import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
 
 import utils
+import engine
 import decoder
+import trackersession
+from pieces import Bitset
 
 
 class Peer:
 
-    MAX_CONN_ATTEMPTS = 3
-
-    def __init__(self, ip, port, nr_pieces, sock=None):
+    def __init__(self, ip, port, nr_pieces):
         self.ip = ip
         self.port = port
         self.nr_pieces = nr_pieces
-        self._is_valid = None
-        self._bitmap = None
         self._pieces_state = None
-        self.pieces_map = {i: None for i in range(nr_pieces)}
-        self.connection_attempts = 0
-        self.errors = set()
-        if not sock:
-            self.sock = self.create_client_socket()
-        else:
-            self.sock = sock
-            self._is_valid = True
-
-        # make it an instance attribute in order for the
-        # current torrent to be registered at this point
-        # and have different transportation instances
-        # for different torrents
-        self.peer_pieces_transport_util = \
-            utils.PiecesPeersTransportFactory.produce(utils.get_current_torrent())
-        self.peer_pieces_transport_util.register(self)
+        self.pieces = Bitset(nr_pieces)
+        self.peer_choking = True
 
     def set_piece_availability(self, piece_ind, avail=True):
-        self.pieces_map[piece_ind] = avail
+        if avail:
+            self.pieces.set(piece_ind)
+        else:
+            self.pieces.clear(piece_ind)
 
     @property
     def bitmap(self):
-        return self._bitmap
+        return self.pieces.snapshot()
 
     @bitmap.setter
     def bitmap(self, bmap):
-        self._bitmap = ''.join(bin(x) for x in bmap).replace('0b', '')
-        for ind, piece in enumerate(self._bitmap[:self.nr_pieces]):
-            self.pieces_map[ind] = bool(int(piece))
+        self.pieces.load(bmap)
 
     def get_pieces_inds_peer_has(self):
-        return [piece_ind for piece_ind in self.pieces_map
-                if self.pieces_map[piece_ind]]
+        return list(self.pieces.indices())
 
     def has_piece(self, piece_ind):
-        return self.pieces_map[piece_ind]
+        return self.pieces.has(piece_ind)
 
     def save_pieces_state(self):
-        self._pieces_state = json.dumps(self.get_pieces_inds_peer_has(),
-                                        sort_keys=True)
+        self._pieces_state = self.pieces.snapshot()
 
     def check_change_in_state(self):
         if self._pieces_state is None:
             return False
-        return json.dumps(self.get_pieces_inds_peer_has(),
-                          sort_keys=True) == self._pieces_state
-
-
-    def create_client_socket(self):
-        """Create socket ready to CONNECT to peers from tracker response"""
-        try:
-            info = socket.getaddrinfo(self.ip, self.port)
-        except socket.gaierror as err:
-            print('Error while connecting to socket: %s' % str(err))
-        else:
-            sock_args = info[0][:3]
-            return socket.socket(*sock_args)
-
-    def reset(self):
-        self._is_valid = None
-        self.connection_attempts = 0
-        self.sock = self.create_client_socket()
-
-    def connect(self, timeout=None):
-        if timeout:
-            self.sock.settimeout(timeout)
-        try:
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            self.sock.bind(("0.0.0.0", 6889))
-            self.connection_attempts += 1
-            self.sock.connect((self.ip, self.port))
-        except socket.error as e:
-            # print('Network failure: ', str(e))
-            if self.connection_attempts == self.MAX_CONN_ATTEMPTS:
-                self.sock.close()
-                self._is_valid = False
-                self.errors.add(str(e))
-            else:
-                # print('Attempting once more...')
-                self.sock.close()
-                self.sock = self.create_client_socket()
-                time.sleep(2)
-                self.connect(timeout)
-        else:
-            self._is_valid = True
-
-    def recv(self, msg_len=5):
-        data = b''
-        while len(data) < msg_len:
-            more = self.sock.recv(msg_len - len(data))
-            if not more:
-                print('INCOMPLETE DATA!')
-                return data
-            data += more
-        return data
-        # return self.sock.recv(msg_len)
-
-    def send(self, msg):
-        self.sock.sendall(msg)
-
-    @property
-    def is_valid(self):
-        return self._is_valid
+        return self.pieces == self._pieces_state
 
     # def get_piece_indices_from_bitmap(self):
     #     if not self.bitmap:
@@ -155,13 +78,56 @@ class SourcePortAdapter(HTTPAdapter):
 
 
 class Tracker:
-
-    def __init__(self, port, compact):
-        self.torrent = utils.get_current_torrent()
+    """
+    Announces the torrent to its trackers (BEP 3, BEP 12).
+
+    The tracker that answered last is asked first, then the tiers in
+    order, all trackers of a tier at once. A lower tier only starts
+    when the ones above it failed or are slow to answer. A tracker that
+    answered moves to the front of its tier. `run` keeps re-announcing
+    on the interval the tracker asks for.
+
+    Requests go through the TrackerSession of each tracker host, which
+    is shared with every other torrent announcing there.
+    """
+
+    TIMEOUT = 15
+    TIER_DELAY = 5
+    MAX_WORKERS = 16
+    DEFAULT_INTERVAL = 1800
+    RETRY_INTERVAL = 30
+    JITTER = 0.1
+
+    def __init__(self, port, compact, torrent=None, sessions=None):
+        self.torrent = torrent or utils.get_current_torrent()
         self.port = port
         self.compact = compact
-        self.session = requests.Session()
-        # self.session.mount('http://', SourcePortAdapter(self.port))
+        self.sessions = sessions or trackersession.SESSIONS
+        self.tiers = self.announce_tiers()
+        self.info_hash = self.torrent.tracker_info_header['info_hash']
+        for session in self.tracker_sessions():
+            session.join(self.info_hash)
+        # url of the tracker that answered last
+        self.current = None
+        self.executor = ThreadPoolExecutor(self.MAX_WORKERS,
+                                           thread_name_prefix='announce')
+        self.stopped = threading.Event()
+
+    def announce_tiers(self):
+        """Tiers of announce urls, shuffled within each tier"""
+        tiers = [list(tier) for tier in
+                 self.torrent.data.get(b'announce-list', []) if tier]
+        for tier in tiers:
+            random.shuffle(tier)
+        return tiers or [[self.torrent.data[b'announce']]]
+
+    def tracker_sessions(self):
+        """Sessions of every tracker of the torrent"""
+        urls = (announce.decode('utf-8', 'replace')
+                for tier in self.tiers for announce in tier)
+        sessions = {self.sessions.session_for(url) for url in urls}
+        sessions.discard(None)
+        return sessions
 
     @property
     def tracker_header(self):
@@ -177,49 +143,151 @@ class Tracker:
         tracker_hdr.update(additional_info)
         return tracker_hdr
 
-    def connect(self):
+    def connect(self, event='started'):
         """
-        Prepare and send request to the tracker
+        Announce to the tracker that answered last, falling back tier
+        by tier. Trackers of a tier are asked concurrently, the next
+        tier starts once the ones before it failed or TIER_DELAY
+        seconds after the previous one. Returns the first successful
+        response or the last failure.
         """
         hdr = self.tracker_header
-        hdr['event'] = 'started'
-        if b'announce-list' in self.torrent.data:
-            announces = self.torrent.data[b'announce-list']
-            for announce in announces:
-                res = self.tracker_request(announce[0], hdr)
-                if b'failure' not in res:
+        if event:
+            hdr['event'] = event
+        current = self.current and self.current.encode('utf-8')
+        tiers = iter(([[current]] if current else []) + [
+            [announce for announce in tier if announce != current]
+            for tier in self.tiers
+        ])
+        res = OrderedDict([(b'failure reason', b'no tracker answered')])
+        running = {}
+        next_start = deadline = time.monotonic()
+        exhausted = False
+        try:
+            while True:
+                now = time.monotonic()
+                if not exhausted and (now >= next_start or not running):
+                    tier = next(tiers, None)
+                    if tier is None:
+                        exhausted = True
+                    else:
+                        for announce in tier:
+                            future = self.executor.submit(
+                                self.tracker_request, announce, hdr)
+                            running[future] = announce
+                        next_start = now + self.TIER_DELAY
+                        deadline = now + self.TIMEOUT + 1
+                        continue
+                if exhausted and (not running or now >= deadline):
                     return res
-            return res
-        else:
-            return self.tracker_request(self.torrent.announce, hdr)
+                timeout = deadline if exhausted else next_start
+                done, _ = futures_wait(running, max(0, timeout - now),
+                                       FIRST_COMPLETED)
+                for future in done:
+                    announce = running.pop(future)
+                    if b'failure reason' in future.result():
+                        res = future.result()
+                        continue
+                    self.promote(announce)
+                    return future.result()
+        finally:
+            for future in running:
+                future.cancel()
+
+    def promote(self, announce):
+        """The tracker answered, ask it first from now on"""
+        for tier in self.tiers:
+            if announce in tier:
+                tier.remove(announce)
+                tier.insert(0, announce)
+        self.current = announce.decode('utf-8', 'replace')
 
     def tracker_request(self, announce, hdr):
         """
-        Actual request sending
+        Actual request sending, runs on a worker thread and reports
+        every error as a failure response
+        """
+        url = announce.decode('utf-8', 'replace')
+        session = self.sessions.session_for(url)
+        if session is None:
+            return trackersession.failure(
+                'unsupported tracker url {}'.format(url))
+        try:
+            return session.announce(url, hdr, self.TIMEOUT)
+        except Exception as err:
+            # an exception would end the announce loop in `run`
+            return trackersession.failure('{}: {!r}'.format(url, err))
+
+    def scrape(self):
+        """Swarm statistics of the torrent from its current tracker"""
+        url = self.current or self.tiers[0][0].decode('utf-8', 'replace')
+        return self.sessions.scrape([(url, self.info_hash)]).get(
+            self.info_hash)
+
+    def next_announce_in(self, resp):
+        """Seconds until the next announce, a bit early but never too early"""
+        interval = resp.get(b'interval')
+        if not isinstance(interval, int) or interval <= 0:
+            interval = self.DEFAULT_INTERVAL
+        min_interval = resp.get(b'min interval')
+        if not isinstance(min_interval, int):
+            min_interval = 0
+        delay = max(interval * random.uniform(1 - self.JITTER, 1),
+                    min_interval)
+        session = self.current and self.sessions.session_for(self.current)
+        if session is None:
+            return delay
+        return session.schedule(delay, max(min_interval, interval / 2),
+                                max(min_interval, interval))
+
+    def run(self, on_response):
         """
-        url_prep = requests.Request('GET', announce.decode('utf-8'),
-                                    params=hdr).prepare()
-        res = self.session.send(url_prep)
-        return res
+        Announce until stopped, handing successful responses to
+        `on_response`. Failed announces are retried with backoff.
+        """
+        event = 'started'
+        completed = self.torrent.left == 0
+        retry = self.RETRY_INTERVAL
+        while not self.stopped.is_set():
+            if event is None and not completed and self.torrent.left == 0:
+                event = 'completed'
+            resp = self.connect(event)
+            if b'failure reason' in resp:
+                print('Announce failed:', resp[b'failure reason'])
+                delay = retry
+                retry = min(2 * retry, self.DEFAULT_INTERVAL)
+            else:
+                completed |= event == 'completed'
+                event = None
+                retry = self.RETRY_INTERVAL
+                on_response(resp)
+                delay = self.next_announce_in(resp)
+            self.stopped.wait(delay)
+        if event != 'started':
+            self.connect('stopped')
+        for session in self.tracker_sessions():
+            session.leave(self.info_hash)
+
+    def stop(self):
+        self.stopped.set()
 
 
 class Client:
 
-    def __init__(self, torrent_path):
+    def __init__(self, torrent_path, max_dials=32, max_peers=80):
         self.torrent = decoder.Torrent(torrent_path)
         utils.register_torrent(self.torrent, PeerMessage)
 
-        self.tracker = Tracker(self.port, self.compact)
-        self.peers = []
-        self.peers_queue = None
+        self.tracker = Tracker(self.port, self.compact, self.torrent)
+        self.announce_thread = threading.Thread(
+            target=self.tracker.run, args=(self.on_announce,), daemon=True)
         self._terminate = False
 
-        self.server_socket_thread = threading.Thread(
-            target=self.create_server_socket
-        )
-
-        self.peer_loop = PeerLoop()
-
+        self.wire_engine = engine.WireEngine(
+            self.torrent, self.torrent.peer_id.encode(),
+            utils.PiecesPeersTransportFactory.produce(self.torrent),
+            max_dials=max_dials, max_peers=max_peers,
+            listener=engine.Listener.on_port(self.port))
 
     @property
     def port(self):
@@ -237,288 +305,69 @@ class Client:
 
     def terminate(self):
         self._terminate = True
+        self.tracker.stop()
+        self.wire_engine.terminate()
+        # drains the disk writer and saves resume data once more
+        self.torrent.pieces_manager.terminate()
 
     def start(self):
         """
         Method for initiating all torrent downloading processes
         """
-        self.peers_queue = utils.get_torrent_peers_queue_rel()
-        self.server_socket_thread.start()
-        self.peer_loop.start()
+        self.wire_engine.start()
         self.torrent.pieces_manager.start()
 
-        tracker_resp = self.tracker.connect()
-        parsed = self.parse_tracker_response(tracker_resp.text.encode('utf-8'))
-        peers = [Peer(ip, port[0], self.torrent.get_nr_of_pieces()) for _, (ip, port)
-                 in parsed[b'peers'].items()]
-        threading.Thread(target=self.connect_to_peers, args=(peers,)).start()
-
-    def parse_peers(self, resp):
-        # following few lines are for eliminating the
-        # string length and the semi colons
-        resp = resp[5:]
-        item = resp[:1]
-        while item in b'0123456789':
-            resp = resp[1:]
-            item = resp[:1]
-        print(resp)
-        resp = resp[1:]
-
-        peers = {}
-        print(resp)
-        try:
-            # 4 bytes for ip addr and 2 for port nr
-            offset = 6
-            ind = 0
-            peer_nr = 0
-            while True:
-                peer_info = resp[ind: ind + offset]
-                peer_ip = socket.inet_ntoa(peer_info[:4])
-                print(peer_info[4:6])
-                peer_port = struct.unpack('!H', peer_info[4:6])
-                peers[peer_nr] = (peer_ip, peer_port)
-
-                peer_nr += 1
-                ind += offset
-        except Exception:
-            pass
-
-        return peers
-
-    def parse_interval(self, resp):
-        resp = resp[9:]
-        interval = bytearray()
-        while resp[:1] in b'0123456789':
-            interval += resp[:1]
-            resp = resp[1:]
-        return int(interval)
-
-    def parse_binary_response(self, resp):
-        possible_items = (b'warning message', b'interval', b'min interval',
-                          b'tracker id', b'complete', b'incomplete', b'peers')
-
-        result = {}
-        for item in possible_items:
-            found = resp.find(item)
-            if found != -1:
-                str_item = item.decode('utf-8')
-                try:
-                    result[item] = getattr(
-                        self, 'parse_{}'.format(str_item))(resp[found:]
-                    )
-                except AttributeError as e:
-                    print('No such parsing method\n', str(e))
-
-        return result
-
-    def parse_tracker_response(self, response):
-        try:
-            # normal response
-            decoded_resp = self.torrent.decode_chunks(response)
-            return decoded_resp
-        except decoder.UnrecognizedTokenError:
-            # binary model response
-            return self.parse_binary_response(response)
-
-    def create_server_socket(self):
-        external_ip = requests.get('https://ipinfo.io/ip').text.strip()
-        serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        try:
-            serv_sock.bind((external_ip, self.port))
-        except OSError:
-            # in case we are behind a NAT
-            serv_sock.bind(('0.0.0.0', self.port))
-        serv_sock.listen(100)
-        while not self._terminate:
-            print('*******************************************************************************************************')
-            print('Waiting for other peers...')
-            client_sock, client_addr = serv_sock.accept()
-            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            self.peers_queue.put(Peer(client_addr[0], client_addr[1],
-                                      self.torrent.get_nr_of_pieces(),
-                                      sock=client_sock))
-
-    def connect_to_peers(self, peer_list):
-        while not self._terminate:
-            for peer_idx, peer in enumerate(peer_list):
-                peer.reset()
-                peer_thr = PeerThread(peer,
-                                      self.peers_queue,
-                                      timeout=20)
-                peer_thr.start()
-                # print(Peer, '{} thread started'.format(peer_idx))
-
-            while any(peer.is_valid is None for peer in peer_list):
-                time.sleep(1)
-
-            print('cycle done')
-            print(len(peer_list))
-            for peer in peer_list:
-                if peer.is_valid:
-                    self.peers.append(peer)
-
-            peer_list = [peer for peer in peer_list if not peer.is_valid]
-
-            time.sleep(2)
-
-
-class PeerThread(threading.Thread):
-
-    def __init__(self, peer, queue, **kwargs):
-        self.peer = peer
-        self.peer_queue = queue
-        super().__init__(kwargs=kwargs)
-
-    def run(self):
-        self.peer.connect(**self._kwargs)
-        if self.peer.is_valid:
-            self.peer_queue.put(self.peer)
-
-
-class PeerLoop(threading.Thread):
-
-    def __init__(self):
-        self.peer_queue = utils.get_torrent_peers_queue_rel()
-        self.peer_messages = utils.get_torrent_msg_rel()
-        self.processed_peers = {}
-        self.message_queues = {}
-        self.peer_msg_rel = {}
-        self._terminate = False
-        super().__init__()
-
-    def run(self):
-        threading.Thread(target=self.peer_communication_handler).start()
-        self._reader_loop()
-
-    def terminate(self):
-        self._terminate = True
-
-    def check_handshake_response(self, resp, handshake):
-        # checking if hash_info matches
-        return resp[28: 48] == handshake[28:48]
+        self.announce_thread.start()
 
-    def runtime_removal(self, peer_sock, *sock_lists):
-        if peer_sock in self.processed_peers:
-            print('TRIENIEEEEEEEEEEEEEEEEEEEEEE')
-            del self.processed_peers[peer_sock]
+    def on_announce(self, tracker_resp):
+        """Dial peers of every successful announce"""
+        self.wire_engine.connector.add(self.parse_peers(tracker_resp))
 
-        for sock_list in sock_lists:
-            if peer_sock in sock_list:
-                sock_list.remove(peer_sock)
-
-    def process_reading_sockets(self, read_sockets, *write_err_sockets):
-        for peer_sock in read_sockets:
-            peer = self.processed_peers[peer_sock]
+    @classmethod
+    def parse_peers(cls, resp):
+        """
+        (ip, port) pairs of the decoded tracker response, in order
+        and without duplicates. Understands compact `peers` (BEP 23)
+        and `peers6` (BEP 7) strings as well as the dictionary model.
+        """
+        peers = resp.get(b'peers', b'')
+        if isinstance(peers, list):
+            addresses = cls.parse_peer_dicts(peers)
+        else:
+            addresses = cls.parse_compact_peers(peers, socket.AF_INET)
+        addresses += cls.parse_compact_peers(resp.get(b'peers6', b''),
+                                              socket.AF_INET6)
+        return list(dict.fromkeys(addresses))
+
+    COMPACT_PEER = {
+        socket.AF_INET: struct.Struct('!4sH'),
+        socket.AF_INET6: struct.Struct('!16sH'),
+    }
 
-            msg = self.peer_msg_rel[peer]
+    @classmethod
+    def parse_compact_peers(cls, data, family):
+        entry = cls.COMPACT_PEER[family]
+        if not isinstance(data, (bytes, bytearray)):
+            return []
+        # a truncated trailing entry is ignored
+        view = memoryview(data)[:len(data) - len(data) % entry.size]
+        if family == socket.AF_INET:
+            return [(socket.inet_ntoa(ip), port)
+                    for ip, port in entry.iter_unpack(view) if port]
+        return [(socket.inet_ntop(family, ip), port)
+                for ip, port in entry.iter_unpack(view) if port]
 
+    @staticmethod
+    def parse_peer_dicts(peers):
+        addresses = []
+        for peer in peers:
             try:
-                if msg and msg.msg_len:
-                    print(msg.msg_len)
-                    resp = peer.recv(msg.msg_len)
-                    first = False
-                else:
-                    resp = peer.recv()
-                    first = True
-            except socket.error as e:
-                print('Erroneous client', str(e))
-                self.runtime_removal(peer_sock, *write_err_sockets)
+                ip, port = peer[b'ip'].decode('ascii'), int(peer[b'port'])
+            except (KeyError, TypeError, AttributeError, ValueError):
                 continue
-
-            time.sleep(0.5)
-            print(peer_sock, 'delegating')
-            print('first', msg.msg_buffer if msg else None)
-            print('resp', resp)
-
-            if not msg or not msg.msg_buffer:
-                try:
-                    msg_instance = self.peer_messages.delegate(resp)
-                    if not msg_instance:
-                        self.runtime_removal(peer_sock, *write_err_sockets)
-                        continue
-                    self.peer_msg_rel[peer] = msg_instance
-                    msg = msg_instance
-                    print('MSG LEN', msg_instance.msg_len)
-                except Exception:
-                    print('Exception occurred', traceback.format_exc())
-                    self.runtime_removal(peer_sock, *write_err_sockets)
-                    continue
-
-            msg.msg_buffer += resp
-
-            if len(msg.msg_buffer) == msg.initial_len + 4:
-                msg.complete_msg = msg.msg_buffer[:]
-                is_valid, reply_type = msg.decode(peer)
-                if is_valid and reply_type:
-                    self.message_queues[peer].put(reply_type)
-                else:
-                    self.runtime_removal(peer_sock, *write_err_sockets)
-                print('second', msg.msg_buffer)
-                msg.msg_buffer = bytearray()
-                print('SUCCESS')
-
-            if first:
-                msg.msg_len -= 1
-            else:
-                msg.msg_len -= len(resp)
-
-    def process_writing_sockets(self, write_sockets, error_sockets):
-
-        for peer_sock in write_sockets:
-            peer = self.processed_peers[peer_sock]
-            msg_queue = self.message_queues[peer]
-            if not msg_queue.empty():
-                msg_type = msg_queue.get_nowait()
-                msg_inst = msg_type()
-                if isinstance(msg_inst, Request):
-                    print('e sho tei we')
-                peer.send(msg_inst)
-            # else:
-                # try:
-                #     peer.send(Handshake(self.peer_messages.peer_id,
-                #                         self.peer_messages.info_hash).encode())
-                #     peer.send(Interested().encode())
-                #     peer.send(Request().encode())
-                # except socket.error as e:
-                #     print('There was an exception:', str(e))
-                #     self.runtime_removal(peer_sock, error_sockets)
-
-            # if not is_valid:
-            #     self.runtime_removal(peer_sock, err)
-            #     continue
-            # if payload:
-            #     data_to_send = msg.next_msg()
-
-            time.sleep(0.1)
-
-    def peer_communication_handler(self):
-        print('starteeeed')
-
-        while not self._terminate:
-            read, write, err = select.select(self.processed_peers.keys(),
-                                             self.processed_peers.keys(),
-                                             [], 0.1)
-
-            self.process_reading_sockets(read, write, err)
-            self.process_writing_sockets(write, err)
-
-            for peer in err:
-                print('Erroneous peer', peer)
-
-    def _reader_loop(self):
-        while not self._terminate:
-            # try:
-            new_peer = self.peer_queue.get()
-            # except queue.Empty:
-            #     continue
-
-            if new_peer not in self.processed_peers:
-                print('new peer')
-                self.processed_peers[new_peer.sock] = new_peer
-                self.message_queues[new_peer] = queue.Queue()
-                self.peer_msg_rel[new_peer] = None
+            if 0 < port < 2**16:
+                addresses.append((ip, port))
+        return addresses
 
 
 class PeerMessage:
@@ -534,6 +383,7 @@ class PeerMessage:
         b'\x07': 'Piece',
         b'\x08': 'Cancel',
         b'\x09': 'Port',
+        b'\x14': 'Extended',
         b'\x13': 'Handshake'
     }
 
@@ -600,13 +450,16 @@ class Handshake(PeerMessage):
 
     handshake_sent_peers = set()
 
+    # reserved bits, counted from the right of the 8 reserved bytes
+    EXTENSION_PROTOCOL = 1 << 20
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def encode(self):
+    def encode(self, extensions=0):
         pstrlen = struct.pack('!B', 19)
         pstr = b'BitTorrent protocol'
-        reserved = struct.pack('!II', 0, 0)
+        reserved = struct.pack('!Q', extensions)
         handshake = b''.join(
             [pstrlen, pstr, reserved, self.info_hash, self.peer_id]
         )
@@ -648,10 +501,11 @@ class Choke(PeerMessage):
     def encode(self):
         return struct.pack('!IB', 1, 0)
 
-    def decode(self, *args, **kwargs):
+    def decode(self, peer, *args, **kwargs):
         # if self.complete_msg[:2] == b'\x01\x00':
         #     return True, self.complete_msg[2:]
         # return False, None
+        peer.peer_choking = True
         return True, self.complete_msg[2:]
 
     def next_step(self, *args, **kwargs):
@@ -663,10 +517,12 @@ class Unchoke(PeerMessage):
     def encode(self):
         return struct.pack('!IB', 1, 1)
 
-    def decode(self, *args, **kwargs):
+    def decode(self, peer, *args, **kwargs):
         # if self.complete_msg[:2] == b'\x01\x01':
         #     return True, self.complete_msg[2:]
         # return False, None
+        peer.peer_choking = False
+        self.pieces_manager.post(self.pieces_manager.PEER_UNCHOKED, peer)
         return True, self.complete_msg[2:]
 
     def next_step(self, *args, **kwargs):
@@ -712,7 +568,9 @@ class Have(PeerMessage):
 
     def decode(self, peer, *args, **kwargs):
         _, _, index = struct.unpack('!IBI', self.complete_msg)
-        peer.set_piece_availability(index)
+        if not peer.has_piece(index):
+            peer.set_piece_availability(index)
+            self.pieces_manager.peer_has(peer, (index,))
         return True, lambda: self.next_step(peer)
 
     def next_step(self, peer):
@@ -729,8 +587,12 @@ class Bitfield(PeerMessage):
         return len_id
 
     def decode(self, peer, *args, **kwargs):
-        bitmap = ''.join(bin(x) for x in self.complete_msg[5:]).replace('0b', '')
-        peer.bitmap = {ind: bool(int(val)) for ind, val in enumerate(bitmap)}
+        self.pieces_manager.peer_gone(peer)
+        try:
+            peer.bitmap = self.complete_msg[5:]
+        except ValueError:
+            return False, None
+        self.pieces_manager.peer_has(peer, peer.get_pieces_inds_peer_has())
         return True, lambda: self.next_step(peer)
 
     def next_step(self, peer, *args, **kwargs):
@@ -759,17 +621,37 @@ class Request(PeerMessage):
         pass
 
 
+class Cancel(PeerMessage):
+
+    def encode(self, index, begin, length):
+        len_id = struct.pack('!IB', 13, 8)
+        payload = struct.pack('!III', index, begin, length)
+        return len_id + payload
+
+    def decode(self, peer, *args, **kwargs):
+        _, _, index, begin, length = struct.unpack('!IBIII', self.complete_msg)
+        return True, None
+
+    def next_step(self, *args, **kwargs):
+        pass
+
+
 class Piece(PeerMessage):
 
     def encode(self, index, begin, block):
         len_id = struct.pack('!IB', len(block) + 9, 7)
-        payload = struct.pack('II', index, begin) + block
+        payload = struct.pack('!II', index, begin) + block
         return len_id + payload
 
     def decode(self, peer, *args, **kwargs):
         _, _, index, offset = struct.unpack('!IBII', self.complete_msg[:13])
         block = self.complete_msg[13:]
-        self.pieces_manager.pieces_data_queue.put((index, offset, block))
+        target = self.pieces_manager.block_buffer(index, offset, len(block),
+                                                  peer)
+        if target is not None:
+            target[:] = block
+            self.pieces_manager.post(self.pieces_manager.BLOCK_RECEIVED,
+                                     index, offset, len(block), peer)
         return True, lambda: self.next_step(peer)
 
     def next_step(self, peer, *args, **kwargs):
@@ -779,6 +661,22 @@ class Piece(PeerMessage):
         return Have().encode(latest_full_piece_ind)
 
 
+class Extended(PeerMessage):
+    """Extension protocol message (BEP 10), id 0 is the handshake"""
+
+    HANDSHAKE_ID = 0
+
+    def encode(self, ext_id, payload):
+        len_id = struct.pack('!IBB', len(payload) + 2, 20, ext_id)
+        return len_id + payload
+
+    def decode(self, *args, **kwargs):
+        return True, None
+
+    def next_step(self, *args, **kwargs):
+        pass
+
+
 if __name__ == '__main__':
     c = Client('/home/ivelin/Downloads/All.She.Wrote.2018.WEB-DL.x264.AAC-REFLUX.torrent')
     c.start()
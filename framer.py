@@ -0,0 +1,133 @@
+import struct
+
+
+class FramingError(Exception):
+    pass
+
+
+class Framer:
+    """
+    Splits the byte stream of a peer connection into frames.
+
+    The connection reads straight into `get_buffer()` and reports the
+    amount with `written()`, then takes frames with `next_frame()`:
+    first the handshake, then length prefixed messages without their
+    length. A keep-alive is an empty frame. Frames are memoryviews into
+    the buffer, valid until the next `get_buffer()` call.
+
+    The buffer is reused as a ring: whenever the free tail gets short
+    the unread bytes, at most one incomplete frame, move to the front.
+
+    Messages with an id in `split` are returned as soon as their first
+    `split[id]` bytes arrived. The consumer then takes the rest with
+    `read_body()`, so that large payloads can go straight to their
+    destination without passing through the buffer.
+    """
+
+    LEN_PREFIX = struct.Struct('!I')
+    HANDSHAKE_FIXED_LEN = 49
+
+    def __init__(self, read_size=2**16, max_frame_len=2**17 + 9, split=None):
+        self.read_size = read_size
+        self.max_frame_len = max_frame_len
+        self.split = split or {}
+        self.buffer = bytearray(read_size)
+        self.start = 0
+        self.end = 0
+        self.needed = 1
+        self.handshake_done = False
+        self.body_pending = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self):
+        """Writable tail of the buffer for the next read"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end < self.read_size // 4 or \
+                len(self.buffer) - self.start < self.needed:
+            self.compact()
+        return memoryview(self.buffer)[self.end:]
+
+    def written(self, nbytes):
+        self.end += nbytes
+
+    def compact(self):
+        """Move unread bytes to the front, growing for big frames"""
+        pending = self.end - self.start
+        size = max(len(self.buffer), self.needed + self.read_size // 4)
+        if size > len(self.buffer):
+            buffer = bytearray(size)
+            buffer[:pending] = self.buffer[self.start: self.end]
+            self.buffer = buffer
+        elif self.start:
+            self.buffer[:pending] = self.buffer[self.start: self.end]
+        self.start, self.end = 0, pending
+
+    def next_frame(self):
+        """Next complete (or split) frame, None if more bytes are needed"""
+        if self.body_pending:
+            raise FramingError('Body of the previous frame not read')
+        available = self.end - self.start
+        if not self.handshake_done:
+            if not available:
+                return None
+            self.needed = self.HANDSHAKE_FIXED_LEN + self.buffer[self.start]
+            if available < self.needed:
+                return None
+            self.handshake_done = True
+            return self.take(0, self.needed)
+
+        if available < 4:
+            self.needed = 4
+            return None
+        (frame_len,) = self.LEN_PREFIX.unpack_from(self.buffer, self.start)
+        if frame_len > self.max_frame_len:
+            raise FramingError('Frame too long: {}'.format(frame_len))
+        if not frame_len:
+            return self.take(4, 0)
+        if available < 5:
+            self.needed = 5
+            return None
+
+        head_len = self.split.get(self.buffer[self.start + 4])
+        if head_len is not None and head_len < frame_len:
+            if available < 4 + head_len:
+                self.needed = 4 + head_len
+                return None
+            self.body_pending = frame_len - head_len
+            return self.take(4, head_len)
+
+        if available < 4 + frame_len:
+            self.needed = 4 + frame_len
+            return None
+        return self.take(4, frame_len)
+
+    def take(self, skip, length):
+        begin = self.start + skip
+        self.start = begin + length
+        self.needed = 1
+        return memoryview(self.buffer)[begin: self.start]
+
+    def read_body(self, target):
+        """
+        Copy the buffered part of a split frame body into `target`,
+        returns how many bytes were copied. The remaining
+        len(target) - copied bytes are still in the socket.
+        """
+        if len(target) != self.body_pending:
+            raise FramingError('Body is {} bytes, not {}'.format(
+                self.body_pending, len(target)))
+        copied = min(self.end - self.start, self.body_pending)
+        target[:copied] = self.buffer[self.start: self.start + copied]
+        self.start += copied
+        self.body_pending = 0
+        return copied
+
+    def frames(self):
+        """Yield every complete frame buffered so far"""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
@@ -0,0 +1,569 @@
+import os
+import re
+import random
+import time
+import queue
+import threading
+from array import array
+from collections import OrderedDict
+
+
+# offsets of the set bits of every byte value, most significant first
+BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte & (0x80 >> bit))
+    for byte in range(256)
+)
+
+
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+def iter_set_bits(bitfield, nr_bits):
+    """Indices of set bits of a BitTorrent (MSB first) bitfield"""
+    # zero bytes are skipped by the regex engine, sparse bitfields
+    # are scanned at C speed
+    for match in NONZERO_BYTE.finditer(bitfield):
+        byte_ind = match.start()
+        byte = bitfield[byte_ind]
+        base = byte_ind * 8
+        for bit in BYTE_BITS[byte]:
+            if base + bit >= nr_bits:
+                return
+            yield base + bit
+
+
+class Bitset:
+    """
+    Set of piece indices stored as a BitTorrent bitfield, one bit per
+    piece with piece 0 in the most significant bit of the first byte.
+    Whole set operations work on the bitfield as one big integer.
+    """
+
+    def __init__(self, nr_bits, bits=None):
+        self.nr_bits = nr_bits
+        self.bits = bytearray((nr_bits + 7) // 8)
+        if bits is not None:
+            self.load(bits)
+
+    def __len__(self):
+        return self.nr_bits
+
+    def __eq__(self, other):
+        if isinstance(other, Bitset):
+            other = other.bits
+        return self.bits == other
+
+    def load(self, bits):
+        """Replace the contents with a received bitfield"""
+        if len(bits) != len(self.bits):
+            raise ValueError('Bitfield of {} bytes, expected {}'.format(
+                len(bits), len(self.bits)))
+        spare = len(self.bits) * 8 - self.nr_bits
+        if spare and bits[-1] & ((1 << spare) - 1):
+            raise ValueError('Bitfield has spare bits set')
+        self.bits[:] = bits
+
+    def has(self, ind):
+        return bool(self.bits[ind >> 3] & (0x80 >> (ind & 7)))
+
+    def set(self, ind):
+        """Returns False if the bit was set already"""
+        if not 0 <= ind < self.nr_bits:
+            raise ValueError('Piece index {} out of range'.format(ind))
+        mask = 0x80 >> (ind & 7)
+        if self.bits[ind >> 3] & mask:
+            return False
+        self.bits[ind >> 3] |= mask
+        return True
+
+    def clear(self, ind):
+        self.bits[ind >> 3] &= ~(0x80 >> (ind & 7)) & 0xff
+
+    def as_int(self):
+        return int.from_bytes(self.bits, 'big')
+
+    def count(self):
+        return self.as_int().bit_count()
+
+    def is_complete(self):
+        return self.count() == self.nr_bits
+
+    def indices(self):
+        return iter_set_bits(self.bits, self.nr_bits)
+
+    def snapshot(self):
+        return bytes(self.bits)
+
+    def missing_from(self, other):
+        """Pieces we have that `other` (a bitfield) has not, as a Bitset"""
+        if isinstance(other, Bitset):
+            other = other.bits
+        diff = self.as_int() & ~int.from_bytes(other, 'big')
+        return Bitset(self.nr_bits, diff.to_bytes(len(self.bits), 'big'))
+
+    def has_any_missing_from(self, other):
+        if isinstance(other, Bitset):
+            other = other.bits
+        return bool(self.as_int() & ~int.from_bytes(other, 'big'))
+
+
+class BufferPool:
+    """
+    Recycled piece sized buffers blocks are received into.
+
+    At most `max_buffers` buffers ever exist, `acquire` returns None
+    once all of them are handed out.
+    """
+
+    def __init__(self, buffer_size, max_bytes=2**27, min_buffers=4):
+        self.buffer_size = buffer_size
+        self.max_buffers = max(min_buffers, max_bytes // buffer_size)
+        self.lock = threading.Lock()
+        self.free = [bytearray(buffer_size) for _ in range(min_buffers)]
+        self.allocated = len(self.free)
+
+    def available(self):
+        return bool(self.free) or self.allocated < self.max_buffers
+
+    def nr_available(self):
+        """Buffers `acquire` can still hand out"""
+        return len(self.free) + self.max_buffers - self.allocated
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            if self.allocated < self.max_buffers:
+                self.allocated += 1
+                return bytearray(self.buffer_size)
+        return None
+
+    def release(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
+
+
+class PieceTable:
+    """
+    Compact piece table of a torrent.
+
+    Piece hashes are served as views over the metainfo `pieces`
+    string and piece objects only exist while a piece is in flight,
+    holding a buffer from the pool. Pieces nobody touched for
+    `idle_timeout` seconds get evicted.
+    """
+
+    HASH_LEN = 20
+
+    def __init__(self, hashes, piece_length, total_length, piece_factory,
+                 buffer_pool, idle_timeout=120):
+        if len(hashes) % self.HASH_LEN:
+            raise ValueError('Pieces hash string has invalid length.')
+        self.hashes = memoryview(hashes)
+        self.piece_length = piece_length
+        self.total_length = total_length
+        self.nr_pieces = len(hashes) // self.HASH_LEN
+        self.piece_factory = piece_factory
+        self.buffer_pool = buffer_pool
+        self.idle_timeout = idle_timeout
+        self.have = bytearray((self.nr_pieces + 7) // 8)
+        self.nr_have = 0
+        # piece index -> piece, least recently used first
+        self.active = OrderedDict()
+        self.last_used = {}
+        # pieces that must not be evicted, e.g. while being hashed
+        self.pinned = set()
+
+    def __len__(self):
+        return self.nr_pieces
+
+    def __getitem__(self, piece_ind):
+        return self.get(piece_ind)
+
+    def piece_hash(self, piece_ind):
+        """SHA1 of the piece as a view over the metainfo"""
+        start = piece_ind * self.HASH_LEN
+        return self.hashes[start: start + self.HASH_LEN]
+
+    def length_of(self, piece_ind):
+        """Length of the piece, the last one is usually shorter"""
+        if piece_ind == self.nr_pieces - 1:
+            return self.total_length - piece_ind * self.piece_length
+        return self.piece_length
+
+    def get(self, piece_ind):
+        """
+        Get in flight piece, creating its state on first access.
+        Returns None when no buffer is left for a new piece.
+        """
+        if not 0 <= piece_ind < self.nr_pieces:
+            raise IndexError('Piece index out of range: {}'.format(piece_ind))
+        piece = self.active.get(piece_ind)
+        if piece is None:
+            buffer = self.buffer_pool.acquire()
+            if buffer is None:
+                return None
+            piece = self.piece_factory(self.length_of(piece_ind),
+                                       self.piece_hash(piece_ind),
+                                       buffer)
+            self.active[piece_ind] = piece
+        else:
+            self.active.move_to_end(piece_ind)
+        self.last_used[piece_ind] = time.monotonic()
+        return piece
+
+    def peek(self, piece_ind):
+        """Get in flight piece without creating or touching it"""
+        return self.active.get(piece_ind)
+
+    def can_start(self, piece_ind):
+        """Whether the piece is in flight or a buffer is left for it"""
+        return piece_ind in self.active or self.buffer_pool.available()
+
+    def pin(self, piece_ind):
+        self.pinned.add(piece_ind)
+
+    def release(self, piece_ind):
+        """Drop in flight state of the piece and recycle its buffer"""
+        self.pinned.discard(piece_ind)
+        self.last_used.pop(piece_ind, None)
+        piece = self.active.pop(piece_ind, None)
+        if piece is not None:
+            self.buffer_pool.release(piece.buffer)
+        return piece
+
+    def has(self, piece_ind):
+        return bool(self.have[piece_ind >> 3] & (0x80 >> (piece_ind & 7)))
+
+    def mark_have(self, piece_ind):
+        """Record verified piece and free its in flight state"""
+        if not self.has(piece_ind):
+            self.have[piece_ind >> 3] |= 0x80 >> (piece_ind & 7)
+            self.nr_have += 1
+        self.release(piece_ind)
+
+    def is_complete(self):
+        return self.nr_have == self.nr_pieces
+
+    def evict_idle(self, now=None, busy=()):
+        """
+        Evict pieces idle for too long, except `busy` ones, returns
+        their indices
+        """
+        deadline = (now or time.monotonic()) - self.idle_timeout
+        evicted = []
+        for piece_ind in self.active:
+            if self.last_used[piece_ind] > deadline:
+                break
+            if piece_ind not in self.pinned and piece_ind not in busy:
+                evicted.append(piece_ind)
+        for piece_ind in evicted:
+            self.release(piece_ind)
+        return evicted
+
+
+class BlockStates:
+    """
+    Block bookkeeping of a whole torrent kept in flat arrays.
+
+    Every block owns one state byte at `piece_ind * blocks_per_piece +
+    block_ind`, while per piece counters and a cursor to the first
+    possibly missing block make the scheduler queries O(1) amortized.
+    Started pieces with blocks still missing are kept in `partial`, so
+    finding them does not walk every piece in flight.
+    """
+
+    MISSING = 0
+    REQUESTED = 1
+    RECEIVED = 2
+
+    BLOCK_SIZE = 2**14  # 16KB block (stated as optimal in wiki)
+
+    def __init__(self, table, block_size=BLOCK_SIZE):
+        self.table = table
+        self.block_size = block_size
+        self.blocks_per_piece = -(-table.piece_length // block_size)
+        nr_pieces = len(table)
+        self.states = bytearray(nr_pieces * self.blocks_per_piece)
+        self.requested = array('I', bytes(4 * nr_pieces))
+        self.received = array('I', bytes(4 * nr_pieces))
+        self.cursor = array('I', bytes(4 * nr_pieces))
+        self.nr_complete = 0
+        last = nr_pieces - 1
+        self.last_piece_blocks = (
+            -(-table.length_of(last) // block_size) if nr_pieces else 0
+        )
+        # torrent wide block counters
+        self.nr_blocks = (max(nr_pieces - 1, 0) * self.blocks_per_piece +
+                          self.last_piece_blocks)
+        self.nr_requested = 0
+        self.nr_received = 0
+        self.partial = set()
+
+    def _track(self, piece_ind):
+        """
+        Keep `partial` in step with a block change of the piece, which
+        stays started until it gets reset, even with nothing requested
+        """
+        if self.missing(piece_ind):
+            self.partial.add(piece_ind)
+        else:
+            self.partial.discard(piece_ind)
+
+    def blocks_in(self, piece_ind):
+        if piece_ind == len(self.table) - 1:
+            return self.last_piece_blocks
+        return self.blocks_per_piece
+
+    def block_length(self, piece_ind, block_ind):
+        offset = block_ind * self.block_size
+        return min(self.block_size, self.table.length_of(piece_ind) - offset)
+
+    def block_of(self, piece_ind, offset, length):
+        """Block index for the (offset, length) pair, None if not aligned"""
+        block_ind, rest = divmod(offset, self.block_size)
+        if (rest or block_ind >= self.blocks_in(piece_ind) or
+                length != self.block_length(piece_ind, block_ind)):
+            return None
+        return block_ind
+
+    def state(self, piece_ind, block_ind):
+        return self.states[piece_ind * self.blocks_per_piece + block_ind]
+
+    def missing(self, piece_ind):
+        return (self.blocks_in(piece_ind) - self.requested[piece_ind] -
+                self.received[piece_ind])
+
+    def next_missing(self, piece_ind):
+        """Index of the first missing block of the piece or None"""
+        base = piece_ind * self.blocks_per_piece
+        found = self.states.find(self.MISSING,
+                                 base + self.cursor[piece_ind],
+                                 base + self.blocks_in(piece_ind))
+        if found == -1:
+            self.cursor[piece_ind] = self.blocks_in(piece_ind)
+            return None
+        self.cursor[piece_ind] = found - base
+        return found - base
+
+    def mark_requested(self, piece_ind, block_ind):
+        pos = piece_ind * self.blocks_per_piece + block_ind
+        if self.states[pos] == self.MISSING:
+            self.states[pos] = self.REQUESTED
+            self.requested[piece_ind] += 1
+            self.nr_requested += 1
+            self._track(piece_ind)
+
+    def mark_missing(self, piece_ind, block_ind):
+        """Give up on a requested block, e.g. when the peer choked us"""
+        pos = piece_ind * self.blocks_per_piece + block_ind
+        if self.states[pos] == self.REQUESTED:
+            self.states[pos] = self.MISSING
+            self.requested[piece_ind] -= 1
+            self.nr_requested -= 1
+            if block_ind < self.cursor[piece_ind]:
+                self.cursor[piece_ind] = block_ind
+            self._track(piece_ind)
+
+    def mark_received(self, piece_ind, block_ind):
+        """Record block data arrival, False for duplicates"""
+        pos = piece_ind * self.blocks_per_piece + block_ind
+        state = self.states[pos]
+        if state == self.RECEIVED:
+            return False
+        if state == self.REQUESTED:
+            self.requested[piece_ind] -= 1
+            self.nr_requested -= 1
+        self.states[pos] = self.RECEIVED
+        self.received[piece_ind] += 1
+        self.nr_received += 1
+        if self.received[piece_ind] == self.blocks_in(piece_ind):
+            self.nr_complete += 1
+        self._track(piece_ind)
+        return True
+
+    def mark_complete(self, piece_ind):
+        """Mark all blocks of the piece received, e.g. on resume"""
+        if self.is_complete(piece_ind):
+            return
+        base = piece_ind * self.blocks_per_piece
+        nr_blocks = self.blocks_in(piece_ind)
+        self.states[base: base + nr_blocks] = bytes([self.RECEIVED]) * nr_blocks
+        self.nr_requested -= self.requested[piece_ind]
+        self.nr_received += nr_blocks - self.received[piece_ind]
+        self.requested[piece_ind] = 0
+        self.received[piece_ind] = nr_blocks
+        self.cursor[piece_ind] = nr_blocks
+        self.nr_complete += 1
+        self.partial.discard(piece_ind)
+
+    def reset_piece(self, piece_ind):
+        """Mark every block of the piece missing again"""
+        if self.is_complete(piece_ind):
+            self.nr_complete -= 1
+        base = piece_ind * self.blocks_per_piece
+        nr_blocks = self.blocks_in(piece_ind)
+        self.states[base: base + nr_blocks] = bytes(nr_blocks)
+        self.nr_requested -= self.requested[piece_ind]
+        self.nr_received -= self.received[piece_ind]
+        self.requested[piece_ind] = 0
+        self.received[piece_ind] = 0
+        self.cursor[piece_ind] = 0
+        self.partial.discard(piece_ind)
+
+    def is_complete(self, piece_ind):
+        """All blocks of the piece received (not necessarily verified)"""
+        return self.received[piece_ind] == self.blocks_in(piece_ind)
+
+    def count_complete(self):
+        return self.nr_complete
+
+    def nr_missing(self):
+        """Blocks of the torrent neither requested nor received"""
+        return self.nr_blocks - self.nr_requested - self.nr_received
+
+    def all_requested(self):
+        """Every block still to come is already requested (endgame)"""
+        return not self.nr_missing() and self.nr_received < self.nr_blocks
+
+
+class HashVerifier:
+    """
+    Pool of worker threads checking SHA1 of completed pieces.
+
+    hashlib releases the GIL while hashing large buffers, so pieces
+    are verified in parallel. Every result is reported through
+    `on_result(piece index, is valid)` from the worker thread. `submit`
+    blocks once `max_pending` pieces are waiting, which holds back
+    the producer.
+    """
+
+    def __init__(self, on_result, nr_workers=None, max_pending=None):
+        self.on_result = on_result
+        self.nr_workers = nr_workers or min(4, os.cpu_count() or 1)
+        self.jobs = queue.Queue(maxsize=max_pending or 2 * self.nr_workers)
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.nr_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        self.workers = []
+
+    def submit(self, piece_ind, piece):
+        self.jobs.put((piece_ind, piece))
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            piece_ind, piece = job
+            self.on_result(piece_ind, piece.check_integrity())
+
+
+class PiecePicker:
+    """
+    Rarest first piece selection.
+
+    Pieces we still need and have not started are kept in buckets by
+    the number of peers having them. Availability changes move a piece
+    between neighbouring buckets in O(1), picking walks buckets from the
+    rarest one and starts at a random spot inside each bucket to break
+    ties. Started pieces leave the buckets until they are reset.
+    """
+
+    def __init__(self, nr_pieces):
+        self.availability = array('I', bytes(4 * nr_pieces))
+        self.position = array('I', bytes(4 * nr_pieces))
+        self.wanted = bytearray(b'\x01') * nr_pieces
+        self.buckets = [list(range(nr_pieces))]
+        for piece_ind in range(nr_pieces):
+            self.position[piece_ind] = piece_ind
+
+    def _remove(self, piece_ind):
+        bucket = self.buckets[self.availability[piece_ind]]
+        pos = self.position[piece_ind]
+        last = bucket.pop()
+        if last != piece_ind:
+            bucket[pos] = last
+            self.position[last] = pos
+
+    def _add(self, piece_ind):
+        count = self.availability[piece_ind]
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.position[piece_ind] = len(bucket)
+        bucket.append(piece_ind)
+
+    def peer_has(self, piece_ind):
+        if self.wanted[piece_ind]:
+            self._remove(piece_ind)
+        self.availability[piece_ind] += 1
+        if self.wanted[piece_ind]:
+            self._add(piece_ind)
+
+    def peer_lost(self, piece_ind):
+        if not self.availability[piece_ind]:
+            return
+        if self.wanted[piece_ind]:
+            self._remove(piece_ind)
+        self.availability[piece_ind] -= 1
+        if self.wanted[piece_ind]:
+            self._add(piece_ind)
+
+    def mark_have(self, piece_ind):
+        """Stop offering a piece we already have"""
+        if self.wanted[piece_ind]:
+            self._remove(piece_ind)
+            self.wanted[piece_ind] = 0
+
+    def mark_started(self, piece_ind):
+        """In flight pieces are requested from the piece table"""
+        self.mark_have(piece_ind)
+
+    def mark_wanted(self, piece_ind):
+        if not self.wanted[piece_ind]:
+            self.wanted[piece_ind] = 1
+            self._add(piece_ind)
+
+    def has_wanted(self):
+        """Whether any peer has a piece we still want"""
+        return any(self.buckets[1:])
+
+    def pick(self, peer_has, limit):
+        """
+        Up to `limit` wanted pieces `peer_has` accepts, rarest first
+        with random order among equally available pieces. They are all
+        collected before returning, starting them moves pieces around
+        in the buckets.
+        """
+        picked = []
+        if limit <= 0:
+            return picked
+        for bucket in self.buckets[1:]:
+            size = len(bucket)
+            if not size:
+                continue
+            start = random.randrange(size)
+            for ind in range(size):
+                piece_ind = bucket[(start + ind) % size]
+                if peer_has(piece_ind):
+                    picked.append(piece_ind)
+                    if len(picked) == limit:
+                        return picked
+        return picked
+
+    def pick_among(self, piece_inds):
+        """Wanted pieces out of `piece_inds`, rarest first"""
+        piece_inds = [piece_ind for piece_ind in piece_inds
+                      if self.wanted[piece_ind]]
+        random.shuffle(piece_inds)
+        piece_inds.sort(key=self.availability.__getitem__)
+        return piece_inds
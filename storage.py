@@ -0,0 +1,426 @@
+import os
+import mmap
+import time
+import queue
+import bisect
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+
+import decoder
+
+
+FileExtent = namedtuple('FileExtent', ['file_ind', 'file_offset', 'length'])
+
+
+class InvalidPathError(Exception):
+    pass
+
+
+class Storage:
+    """
+    Maps the torrent byte space onto its files.
+
+    A sorted list of file start offsets answers which file extents a
+    piece or block covers with a bisect. Data goes to disk with
+    pread/pwrite on descriptors kept in a bounded LRU, so torrents with
+    thousands of files neither reopen files nor run out of descriptors.
+    """
+
+    IOV_MAX = 1024
+
+    def __init__(self, info, download_dir='.', max_open_files=64):
+        self.piece_length = int(info[b'piece length'])
+        self.root = os.fsencode(download_dir)
+        name = self.sanitize(info[b'name'])
+        if b'files' in info:
+            self.files = [
+                (os.path.join(self.root, name,
+                              *(self.sanitize(part) for part in f[b'path'])),
+                 int(f[b'length']))
+                for f in info[b'files']
+            ]
+        else:
+            self.files = [(os.path.join(self.root, name),
+                           int(info[b'length']))]
+        self.offsets = []
+        total = 0
+        for _, length in self.files:
+            self.offsets.append(total)
+            total += length
+        self.total_length = total
+        self.max_open_files = max_open_files
+        self.open_files = OrderedDict()
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sanitize(part):
+        """Reject path components escaping the download directory"""
+        if not part or part in (b'.', b'..') or b'/' in part or \
+                b'\\' in part or b'\x00' in part:
+            raise InvalidPathError('Invalid path component: {!r}'.format(part))
+        return part
+
+    def extents(self, offset, length):
+        """File extents covering `length` bytes from global `offset`"""
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError('Range outside of torrent data.')
+        extents = []
+        file_ind = bisect.bisect_right(self.offsets, offset) - 1
+        while length > 0:
+            file_start = self.offsets[file_ind]
+            file_len = self.files[file_ind][1]
+            file_offset = offset - file_start
+            chunk = min(length, file_len - file_offset)
+            if chunk > 0:
+                extents.append(FileExtent(file_ind, file_offset, chunk))
+                offset += chunk
+                length -= chunk
+            file_ind += 1
+        return extents
+
+    def piece_extents(self, piece_ind, piece_len):
+        return self.extents(piece_ind * self.piece_length, piece_len)
+
+    def block_extents(self, piece_ind, begin, length):
+        return self.extents(piece_ind * self.piece_length + begin, length)
+
+    def get_fd(self, file_ind):
+        """Descriptor of the file, opening it and evicting the LRU one"""
+        with self.lock:
+            fd = self.open_files.get(file_ind)
+            if fd is not None:
+                self.open_files.move_to_end(file_ind)
+                return fd
+            path = self.files[file_ind][0]
+            os.makedirs(os.path.dirname(path) or b'.', exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.open_files[file_ind] = fd
+            if len(self.open_files) > self.max_open_files:
+                old_ind, old_fd = self.open_files.popitem(last=False)
+                if old_ind in self.dirty:
+                    self.dirty.discard(old_ind)
+                    os.fsync(old_fd)
+                os.close(old_fd)
+            return fd
+
+    def write(self, offset, data):
+        self.writev(offset, [data])
+
+    def writev(self, offset, buffers):
+        """
+        Write consecutive buffers starting at global `offset`, using a
+        single pwritev per covered file extent
+        """
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        view_ind, view_pos = 0, 0
+        for extent in self.extents(offset, sum(len(v) for v in views)):
+            parts = []
+            needed = extent.length
+            while needed:
+                view = views[view_ind]
+                take = min(needed, len(view) - view_pos)
+                parts.append(view[view_pos: view_pos + take])
+                needed -= take
+                view_pos += take
+                if view_pos == len(view):
+                    view_ind, view_pos = view_ind + 1, 0
+            fd = self.get_fd(extent.file_ind)
+            self.dirty.add(extent.file_ind)
+            self._pwritev_all(fd, parts, extent.file_offset)
+
+    @staticmethod
+    def _pwritev_all(fd, parts, offset):
+        while parts:
+            written = os.pwritev(fd, parts[:Storage.IOV_MAX], offset)
+            offset += written
+            while parts and written >= len(parts[0]):
+                written -= len(parts[0])
+                parts.pop(0)
+            if parts and written:
+                parts[0] = parts[0][written:]
+
+    def sync(self):
+        """fsync every file written to since the last sync"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            for file_ind in dirty:
+                fd = self.open_files.get(file_ind)
+                if fd is not None:
+                    os.fsync(fd)
+
+    def read(self, offset, length):
+        data = bytearray()
+        for extent in self.extents(offset, length):
+            data += os.pread(self.get_fd(extent.file_ind), extent.length,
+                             extent.file_offset)
+        return data
+
+    def file_stats(self):
+        """(size, mtime in ns) of every file, (-1, -1) for missing ones"""
+        stats = []
+        for path, _ in self.files:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stats.append((-1, -1))
+            else:
+                stats.append((st.st_size, st.st_mtime_ns))
+        return stats
+
+    def has_data(self):
+        return any(os.path.exists(path) for path, _ in self.files)
+
+    def reader(self, file_ind):
+        """
+        Unbuffered file object for serving the file, with a descriptor
+        of its own so that LRU eviction cannot close it under the caller
+        """
+        return open(self.files[file_ind][0], 'rb', buffering=0)
+
+    def write_piece(self, piece_ind, data):
+        self.write(piece_ind * self.piece_length, data)
+
+    def read_block(self, piece_ind, begin, length):
+        return self.read(piece_ind * self.piece_length + begin, length)
+
+    def close(self):
+        with self.lock:
+            while self.open_files:
+                os.close(self.open_files.popitem()[1])
+
+
+class DiskWriter(threading.Thread):
+    """
+    Writes verified pieces to storage off the network path.
+
+    Queued pieces are sorted and runs of consecutive pieces are merged
+    into single vectored writes. fsync is batched by bytes and time.
+    Once more than `max_pending_bytes` wait in the queue `over_budget`
+    tells the scheduler to back off. Outcome of every piece is reported
+    through `on_done(piece index, error or None)`.
+    """
+
+    def __init__(self, storage, on_done, max_pending_bytes=2**26,
+                 max_run_bytes=2**24, fsync_bytes=2**26, fsync_interval=5):
+        super().__init__(daemon=True)
+        self.storage = storage
+        self.on_done = on_done
+        self.max_pending_bytes = max_pending_bytes
+        self.max_run_bytes = max_run_bytes
+        self.fsync_bytes = fsync_bytes
+        self.fsync_interval = fsync_interval
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.unsynced_bytes = 0
+        self.last_sync = time.monotonic()
+        self.started = time.monotonic()
+        self.nr_writes = 0
+        self.nr_syncs = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._terminate = False
+
+    def submit(self, piece_ind, data):
+        with self.lock:
+            self.pending_bytes += len(data)
+        self.jobs.put((piece_ind, data))
+
+    def over_budget(self):
+        return self.pending_bytes > self.max_pending_bytes
+
+    def terminate(self):
+        self.jobs.put(None)
+
+    def run(self):
+        while not self._terminate:
+            try:
+                job = self.jobs.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                self.maybe_sync(force=True)
+                continue
+            batch = []
+            while job is not None:
+                batch.append(job)
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+            if job is None:
+                self._terminate = True
+            for run in self.coalesce(sorted(batch, key=lambda j: j[0])):
+                self.write_run(run)
+            self.maybe_sync()
+        self.maybe_sync(force=True)
+        self.storage.close()
+
+    def coalesce(self, batch):
+        """Split sorted jobs into runs of consecutive pieces"""
+        run, run_bytes = [], 0
+        for piece_ind, data in batch:
+            if run and (piece_ind != run[-1][0] + 1 or
+                        run_bytes + len(data) > self.max_run_bytes):
+                yield run
+                run, run_bytes = [], 0
+            run.append((piece_ind, data))
+            run_bytes += len(data)
+        if run:
+            yield run
+
+    def write_run(self, run):
+        nbytes = sum(len(data) for _, data in run)
+        start = time.monotonic()
+        try:
+            self.storage.writev(run[0][0] * self.storage.piece_length,
+                                [data for _, data in run])
+        except OSError as err:
+            error = err
+        else:
+            error = None
+        latency = time.monotonic() - start
+        with self.lock:
+            self.pending_bytes -= nbytes
+            self.nr_writes += 1
+            self.write_time += latency
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            if not error:
+                self.bytes_written += nbytes
+                self.unsynced_bytes += nbytes
+        for piece_ind, _ in run:
+            self.on_done(piece_ind, error)
+
+    def maybe_sync(self, force=False):
+        now = time.monotonic()
+        if not self.unsynced_bytes:
+            return
+        if force or self.unsynced_bytes >= self.fsync_bytes or \
+                now - self.last_sync >= self.fsync_interval:
+            self.storage.sync()
+            self.unsynced_bytes = 0
+            self.last_sync = now
+            self.nr_syncs += 1
+
+    def stats(self):
+        """Queue and throughput figures of the disk stage"""
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'pending_bytes': self.pending_bytes,
+                'bytes_written': self.bytes_written,
+                'bytes_per_sec': self.bytes_written / elapsed,
+                'disk_bytes_per_sec':
+                    self.bytes_written / self.write_time if self.write_time else 0.0,
+                'writes': self.nr_writes,
+                'fsyncs': self.nr_syncs,
+                'avg_write_latency':
+                    self.write_time / self.nr_writes if self.nr_writes else 0.0,
+                'last_write_latency': self.last_latency,
+                'max_write_latency': self.max_latency,
+            }
+
+
+class ResumeData:
+    """
+    Verified pieces bitfield of a torrent persisted per info-hash
+    together with size and mtime of its files, so a restart can skip
+    rechecking when nothing changed on disk.
+    """
+
+    def __init__(self, storage, info_hash, resume_dir=None):
+        self.storage = storage
+        self.info_hash = info_hash
+        self.resume_dir = resume_dir or os.path.join(storage.root, b'.resume')
+        self.path = os.path.join(self.resume_dir,
+                                 info_hash.hex().encode() + b'.resume')
+
+    def load(self, bitfield_len):
+        """Stored bitfield, None if missing, corrupt or outdated"""
+        try:
+            with open(self.path, 'rb') as fd:
+                data = decoder.OrderedDecoder(fd.read()).decode()
+        except (OSError, decoder.UnrecognizedTokenError):
+            return None
+        try:
+            if data[b'info-hash'] != self.info_hash or \
+                    len(data[b'pieces']) != bitfield_len:
+                return None
+            stored_stats = [tuple(stat) for stat in data[b'files']]
+        except (KeyError, TypeError):
+            return None
+        if stored_stats != self.storage.file_stats():
+            return None
+        return bytearray(data[b'pieces'])
+
+    def save(self, bitfield):
+        """Atomically replace the resume file"""
+        os.makedirs(self.resume_dir, exist_ok=True)
+        data = OrderedDict([
+            (b'files', [list(stat) for stat in self.storage.file_stats()]),
+            (b'info-hash', self.info_hash),
+            (b'pieces', bytes(bitfield)),
+        ])
+        tmp_path = self.path + b'.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(decoder.OrderedEncoder(data).encode())
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def recheck(storage, table, nr_workers=None):
+    """
+    Hash every piece found on disk and return the bitfield of the
+    valid ones. Files are mmapped and contiguous ranges of pieces are
+    hashed on a thread pool (hashlib releases the GIL while hashing).
+    """
+    bitfield = bytearray(len(table.have))
+    maps = {}
+    for file_ind, (path, length) in enumerate(storage.files):
+        if not length:
+            continue
+        try:
+            with open(path, 'rb') as fd:
+                if os.fstat(fd.fileno()).st_size < length:
+                    continue
+                maps[file_ind] = mmap.mmap(fd.fileno(), length,
+                                           access=mmap.ACCESS_READ)
+        except OSError:
+            continue
+
+    def check_range(start, end):
+        valid = []
+        for piece_ind in range(start, end):
+            extents = storage.piece_extents(piece_ind,
+                                            table.length_of(piece_ind))
+            if any(ext.file_ind not in maps for ext in extents):
+                continue
+            sha1 = hashlib.sha1()
+            for ext in extents:
+                with memoryview(maps[ext.file_ind]) as view:
+                    sha1.update(view[ext.file_offset:
+                                     ext.file_offset + ext.length])
+            if sha1.digest() == table.piece_hash(piece_ind):
+                valid.append(piece_ind)
+        return valid
+
+    nr_workers = nr_workers or os.cpu_count() or 1
+    step = max(1, -(-len(table) // (nr_workers * 4)))
+    try:
+        with ThreadPoolExecutor(nr_workers) as pool:
+            ranges = [pool.submit(check_range, start,
+                                  min(start + step, len(table)))
+                      for start in range(0, len(table), step)]
+            for future in ranges:
+                for piece_ind in future.result():
+                    bitfield[piece_ind >> 3] |= 0x80 >> (piece_ind & 7)
+    finally:
+        for mapped in maps.values():
+            mapped.close()
+    return bitfield
@@ -0,0 +1,230 @@
+"""
+Tracker sessions shared by all torrents.
+
+There is one TrackerSession per tracker host. Its HTTP connections are
+pooled and kept alive across the announces of every torrent using the
+tracker, scrapes for many torrents go out batched in one request and
+re-announces are spread over the announce interval instead of firing
+together.
+"""
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import decoder
+import udptracker
+
+
+def failure(reason):
+    return OrderedDict([(b'failure reason', reason.encode())])
+
+
+def scrape_url(url):
+    """
+    Scrape url of an HTTP announce url by the usual convention,
+    None if the tracker does not support scraping
+    """
+    parts = urlsplit(url)
+    head, _, last = parts.path.rpartition('/')
+    if not last.startswith('announce'):
+        return None
+    path = head + '/scrape' + last[len('announce'):]
+    return urlunsplit(parts._replace(path=path))
+
+
+class TrackerSession:
+    """
+    Everything talking to one tracker host: a pooled HTTP session, the
+    shared UDP client and the announce schedule of the torrents there
+    """
+
+    TIMEOUT = 15
+    POOL_SIZE = 8
+    # keeps the query string of a scrape around 4KB
+    MAX_SCRAPE_HASHES = 64
+
+    def __init__(self, host, udp):
+        self.host = host
+        self.udp = udp
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.torrents = set()
+        # sorted monotonic times of upcoming announces
+        self.scheduled = []
+
+    def join(self, info_hash):
+        with self.lock:
+            self.torrents.add(info_hash)
+
+    def leave(self, info_hash):
+        with self.lock:
+            self.torrents.discard(info_hash)
+
+    # announce
+
+    def announce(self, url, hdr, timeout=TIMEOUT):
+        """Announce to the tracker, giving up after `timeout` seconds"""
+        if url.startswith('udp://'):
+            return self.udp_announce(url, hdr, timeout)
+        return self.http_announce(url, hdr, timeout)
+
+    def http_announce(self, url, hdr, timeout=TIMEOUT):
+        try:
+            url_prep = requests.Request('GET', url, params=hdr).prepare()
+            res = self.http.send(url_prep, stream=True, timeout=timeout)
+            return self.decode_response(res)
+        except (requests.RequestException, ValueError,
+                decoder.UnrecognizedTokenError) as err:
+            return failure('{}: {}'.format(url, err))
+
+    def udp_announce(self, url, hdr, timeout=TIMEOUT):
+        try:
+            return self.udp.announce(
+                url, hdr['info_hash'], hdr['peer_id'].encode(),
+                downloaded=hdr['downloaded'], left=hdr['left'],
+                uploaded=hdr['uploaded'], event=hdr.get('event'),
+                port=hdr['port'], timeout=timeout)
+        except udptracker.UDPTrackerError as err:
+            return failure('{}: {}'.format(url, err))
+
+    def decode_response(self, res, chunk_size=2**14):
+        """
+        Decode the bencoded response body while it is still arriving
+        """
+        bdecoder = decoder.IncrementalDecoder()
+        with res:
+            for chunk in res.iter_content(chunk_size):
+                bdecoder.feed(chunk)
+        bdecoder.close()
+        resp = next(bdecoder.events(), None)
+        if not isinstance(resp, dict):
+            return failure('malformed response')
+        return resp
+
+    def schedule(self, delay, earliest, latest):
+        """
+        Seconds until an announce wanted in `delay` seconds should go
+        out, between `earliest` and `latest`. Announces of the torrents
+        here are kept (latest - earliest) / torrents apart so that they
+        spread over that window: the first free slot after `delay` is
+        taken, or the last one before it if that would be too late.
+        """
+        with self.lock:
+            now = time.monotonic()
+            del self.scheduled[:bisect.bisect_right(self.scheduled, now)]
+            spacing = (latest - earliest) / max(1, len(self.torrents))
+            wanted = now + delay
+            due = wanted
+            ind = bisect.bisect_left(self.scheduled, due - spacing)
+            while ind < len(self.scheduled) and \
+                    self.scheduled[ind] < due + spacing:
+                due = self.scheduled[ind] + spacing
+                ind += 1
+            if due > now + latest:
+                due = wanted
+                ind = bisect.bisect_right(self.scheduled, due + spacing) - 1
+                while ind >= 0 and self.scheduled[ind] > due - spacing:
+                    due = self.scheduled[ind] - spacing
+                    ind -= 1
+                if due < now + earliest:
+                    due = wanted
+            bisect.insort(self.scheduled, due)
+        return due - now
+
+    # scrape
+
+    def scrape(self, url, info_hashes):
+        """
+        Swarm statistics of many torrents, info hash -> dict with
+        complete, downloaded and incomplete counts. Torrents the
+        tracker did not report on are left out.
+        """
+        info_hashes = list(info_hashes)
+        if url.startswith('udp://'):
+            try:
+                return self.udp.scrape(url, info_hashes, self.TIMEOUT)
+            except udptracker.UDPTrackerError as err:
+                print('Scrape failed: {}: {}'.format(url, err))
+                return OrderedDict()
+        url = scrape_url(url)
+        stats = OrderedDict()
+        if url is None:
+            return stats
+        for start in range(0, len(info_hashes), self.MAX_SCRAPE_HASHES):
+            chunk = info_hashes[start: start + self.MAX_SCRAPE_HASHES]
+            params = [('info_hash', info_hash) for info_hash in chunk]
+            try:
+                url_prep = requests.Request('GET', url,
+                                            params=params).prepare()
+                res = self.http.send(url_prep, stream=True,
+                                     timeout=self.TIMEOUT)
+                resp = self.decode_response(res)
+            except (requests.RequestException, ValueError,
+                    decoder.UnrecognizedTokenError) as err:
+                print('Scrape failed: {}: {}'.format(url, err))
+                continue
+            files = resp.get(b'files')
+            if not isinstance(files, dict):
+                continue
+            for info_hash in chunk:
+                if isinstance(files.get(info_hash), dict):
+                    stats[info_hash] = files[info_hash]
+        return stats
+
+    def close(self):
+        self.http.close()
+
+
+class TrackerSessions:
+    """Registry of the tracker sessions, one per tracker host"""
+
+    def __init__(self, udp=None):
+        self.udp = udp or udptracker.UDPTrackerClient()
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def session_for(self, url):
+        """Session of the tracker at `url`, None for unsupported urls"""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https', 'udp') or not parts.netloc:
+            return None
+        host = (parts.scheme, parts.netloc.lower())
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = TrackerSession(host, self.udp)
+            return session
+
+    def scrape(self, torrents):
+        """
+        Scrape many torrents at once, `torrents` are (announce url,
+        info hash) pairs. Torrents sharing a tracker go out in batched
+        requests, returns info hash -> stats.
+        """
+        by_url = OrderedDict()
+        for url, info_hash in torrents:
+            by_url.setdefault(url, []).append(info_hash)
+        stats = OrderedDict()
+        for url, info_hashes in by_url.items():
+            session = self.session_for(url)
+            if session is not None:
+                stats.update(session.scrape(url, info_hashes))
+        return stats
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            session.close()
+        self.udp.close()
+
+
+SESSIONS = TrackerSessions()
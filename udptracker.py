@@ -0,0 +1,235 @@
+"""
+UDP tracker protocol client (BEP 15).
+
+One socket per address family carries any number of transactions at
+once, a receiver thread hands responses to the waiting requests by
+their transaction id. Connection ids are cached for a minute, lost
+packets are retransmitted after 15 * 2 ** n seconds. Callers that
+cannot wait for the whole schedule pass a timeout for the request.
+"""
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+class UDPTrackerError(Exception):
+    pass
+
+
+class UDPTrackerClient:
+
+    PROTOCOL_ID = 0x41727101980
+    CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+    EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+    BASE_TIMEOUT = 15
+    MAX_RETRIES = 8
+    CONNECTION_ID_TTL = 60
+    MAX_SCRAPE_HASHES = 74
+    MAX_PACKET = 2**16
+
+    REQUEST_HEADER = struct.Struct('!QII')
+    RESPONSE_HEADER = struct.Struct('!II')
+    CONNECTION_ID = struct.Struct('!Q')
+    ANNOUNCE_REQUEST = struct.Struct('!20s20sQQQIIIiH')
+    ANNOUNCE_RESPONSE = struct.Struct('!III')
+    SCRAPE_ENTRY = struct.Struct('!III')
+
+    def __init__(self, base_timeout=BASE_TIMEOUT, max_retries=MAX_RETRIES):
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.sockets = {}
+        # transaction id -> [address, done event, response]
+        self.pending = {}
+        # address -> (connection id, expiry time)
+        self.connection_ids = {}
+        self.key = random.getrandbits(32)
+
+    # transport
+
+    def socket_for(self, family):
+        with self.lock:
+            sock = self.sockets.get(family)
+            if sock is None:
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                self.sockets[family] = sock
+                threading.Thread(target=self.receive, args=(sock,),
+                                 daemon=True).start()
+            return sock
+
+    def receive(self, sock):
+        """Receiver loop, matches responses to pending transactions"""
+        while True:
+            try:
+                data, address = sock.recvfrom(self.MAX_PACKET)
+            except OSError:
+                return
+            if len(data) < self.RESPONSE_HEADER.size:
+                continue
+            _, transaction_id = self.RESPONSE_HEADER.unpack_from(data)
+            with self.lock:
+                waiting = self.pending.get(transaction_id)
+                if waiting is None or waiting[0][:2] != address[:2]:
+                    continue
+                del self.pending[transaction_id]
+            waiting[2] = data
+            waiting[1].set()
+
+    def transact(self, address, family, build, timeout):
+        """
+        Send the packet `build(transaction_id)` returns and wait for
+        the answer, returns (action, body) or None on timeout
+        """
+        waiting = [address, threading.Event(), None]
+        with self.lock:
+            transaction_id = random.getrandbits(32)
+            while transaction_id in self.pending:
+                transaction_id = random.getrandbits(32)
+            self.pending[transaction_id] = waiting
+        try:
+            try:
+                self.socket_for(family).sendto(build(transaction_id),
+                                               address)
+            except OSError as err:
+                # e.g. no route for the address family of the tracker
+                raise UDPTrackerError('{}: {}'.format(address[0], err))
+            if not waiting[1].wait(timeout):
+                return None
+        finally:
+            with self.lock:
+                self.pending.pop(transaction_id, None)
+        action, _ = self.RESPONSE_HEADER.unpack_from(waiting[2])
+        body = waiting[2][self.RESPONSE_HEADER.size:]
+        if action == self.ERROR:
+            raise UDPTrackerError(body.decode('utf-8', 'replace'))
+        return action, body
+
+    def connection_id(self, address, family, timeout):
+        """Cached connection id of the tracker, None on timeout"""
+        with self.lock:
+            connection_id, expiry = self.connection_ids.get(address, (0, 0))
+        if expiry > time.monotonic():
+            return connection_id
+        res = self.transact(
+            address, family,
+            lambda tid: self.REQUEST_HEADER.pack(self.PROTOCOL_ID,
+                                                 self.CONNECT, tid),
+            timeout)
+        if res is None:
+            return None
+        action, body = res
+        if action != self.CONNECT or len(body) < self.CONNECTION_ID.size:
+            raise UDPTrackerError('Malformed connect response')
+        (connection_id,) = self.CONNECTION_ID.unpack_from(body)
+        with self.lock:
+            self.connection_ids[address] = (
+                connection_id, time.monotonic() + self.CONNECTION_ID_TTL)
+        return connection_id
+
+    def request(self, url, action, payload, timeout=None):
+        """
+        Connect if needed and send the request, retransmitting with
+        the BEP 15 schedule, returns the response body. With a
+        `timeout` the retransmissions stop after that many seconds.
+        """
+        address, family = self.resolve(url)
+        deadline = timeout and time.monotonic() + timeout
+        for attempt in range(self.max_retries + 1):
+            wait = self.base_timeout * 2 ** attempt
+            if deadline and deadline - time.monotonic() <= 0:
+                break
+            connection_id = self.connection_id(
+                address, family, self.clip(wait, deadline))
+            if connection_id is None:
+                continue
+            res = self.transact(
+                address, family,
+                lambda tid: self.REQUEST_HEADER.pack(connection_id, action,
+                                                     tid) + payload,
+                self.clip(wait, deadline))
+            if res is None:
+                # the connection id may have gone stale meanwhile
+                with self.lock:
+                    self.connection_ids.pop(address, None)
+                continue
+            if res[0] != action:
+                raise UDPTrackerError('Unexpected action {}'.format(res[0]))
+            return res[1], family
+        raise UDPTrackerError('{} timed out'.format(url))
+
+    @staticmethod
+    def clip(wait, deadline):
+        """`wait` cut short to the time left until `deadline`"""
+        if not deadline:
+            return wait
+        return max(0, min(wait, deadline - time.monotonic()))
+
+    @staticmethod
+    def resolve(url):
+        parts = urlsplit(url)
+        if parts.scheme != 'udp' or not parts.hostname or not parts.port:
+            raise UDPTrackerError('Not a udp tracker url: {}'.format(url))
+        try:
+            info = socket.getaddrinfo(parts.hostname, parts.port,
+                                      type=socket.SOCK_DGRAM)
+        except OSError as err:
+            raise UDPTrackerError('{}: {}'.format(url, err))
+        family, _, _, _, address = info[0]
+        return address, family
+
+    # tracker actions
+
+    def announce(self, url, info_hash, peer_id, downloaded=0, left=0,
+                 uploaded=0, event=None, port=6889, num_want=-1,
+                 timeout=None):
+        """
+        Announce the torrent, returns the response in the shape of an
+        HTTP tracker one (interval, complete, incomplete, peers/peers6)
+        """
+        payload = self.ANNOUNCE_REQUEST.pack(
+            info_hash, peer_id, downloaded, left, uploaded,
+            self.EVENTS[event], 0, self.key, num_want, port)
+        body, family = self.request(url, self.ANNOUNCE, payload, timeout)
+        if len(body) < self.ANNOUNCE_RESPONSE.size:
+            raise UDPTrackerError('Malformed announce response')
+        interval, leechers, seeders = self.ANNOUNCE_RESPONSE.unpack_from(body)
+        peers_key = b'peers6' if family == socket.AF_INET6 else b'peers'
+        return OrderedDict([
+            (b'interval', interval),
+            (b'complete', seeders),
+            (b'incomplete', leechers),
+            (peers_key, body[self.ANNOUNCE_RESPONSE.size:]),
+        ])
+
+    def scrape(self, url, info_hashes, timeout=None):
+        """
+        Swarm statistics, info hash -> dict with complete, downloaded
+        and incomplete counts like an HTTP scrape
+        """
+        stats = OrderedDict()
+        for start in range(0, len(info_hashes), self.MAX_SCRAPE_HASHES):
+            chunk = info_hashes[start: start + self.MAX_SCRAPE_HASHES]
+            body, _ = self.request(url, self.SCRAPE, b''.join(chunk),
+                                   timeout)
+            nr_entries = min(len(chunk), len(body) // self.SCRAPE_ENTRY.size)
+            entries = self.SCRAPE_ENTRY.iter_unpack(
+                body[:nr_entries * self.SCRAPE_ENTRY.size])
+            for info_hash, (seeders, completed, leechers) in zip(chunk,
+                                                                 entries):
+                stats[info_hash] = OrderedDict([
+                    (b'complete', seeders),
+                    (b'downloaded', completed),
+                    (b'incomplete', leechers),
+                ])
+        return stats
+
+    def close(self):
+        with self.lock:
+            sockets, self.sockets = self.sockets, {}
+        for sock in sockets.values():
+            sock.close()
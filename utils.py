@@ -53,10 +53,60 @@ class PiecesPeersTransport:
     def __init__(self):
         self.lock = threading.Lock()
         self.peers_pieces_queues = {}
+        self.notifiers = {}
 
-    def register(self, peer):
+    DEFAULT_QUEUE_SIZE = 5
+
+    def register(self, peer, notify=None, size=DEFAULT_QUEUE_SIZE):
+        """
+        Create request queue of the peer, `notify` gets called
+        whenever new requests were put in it
+        """
+        with self.lock:
+            self.peers_pieces_queues[peer] = queue.Queue(maxsize=size)
+            if notify:
+                self.notifiers[peer] = notify
+
+    def unregister(self, peer):
+        """Drop the peer, returning requests still waiting in its queue"""
+        with self.lock:
+            piece_queue = self.peers_pieces_queues.pop(peer, None)
+            self.notifiers.pop(peer, None)
+        return self.take_all(piece_queue)
+
+    def drain(self, peer):
+        """Empty the queue of the peer in place, returning its requests"""
+        with self.lock:
+            piece_queue = self.peers_pieces_queues.get(peer)
+        return self.take_all(piece_queue)
+
+    @staticmethod
+    def take_all(piece_queue):
+        pending = []
+        while piece_queue is not None and not piece_queue.empty():
+            pending.append(piece_queue.get_nowait())
+        return pending
+
+    def resize(self, peer, size):
+        """
+        Change how many requests may wait in the queue of the peer,
+        returns True when it has grown and can take more
+        """
         with self.lock:
-            self.peers_pieces_queues[peer] = queue.Queue(maxsize=5)
+            piece_queue = self.peers_pieces_queues.get(peer)
+        if piece_queue is None:
+            return False
+        with piece_queue.mutex:
+            grown = size > piece_queue.maxsize
+            piece_queue.maxsize = size
+            if grown:
+                piece_queue.not_full.notify_all()
+        return grown
+
+    def notify(self, peer):
+        notify = self.notifiers.get(peer)
+        if notify:
+            notify()
 
     def __getitem__(self, item):
         return self.peers_pieces_queues[item]